@@ -0,0 +1,112 @@
+from datetime import datetime
+from itertools import chain
+from operator import itemgetter
+
+import numpy as np
+
+# Fields of the weekly activity, in the order they are stored in the matrix
+COMMITS, ADDITIONS, DELETIONS = 0, 1, 2
+
+_week_fields = itemgetter('w', 'c', 'a', 'd')
+
+
+class ActivityMatrix:
+    # Weekly activity of every contributor to every repository, as sent by /stats/contributors, loaded into a single
+    # fields × pairs × weeks array, with a row for each (repository, author) pair that occurs in the responses.
+    # Commits, additions and deletions over any time window are sums over a slice of the weeks axis, instead of
+    # walking the weeks of every author of every repository again, then reduced by author.
+    # Only weeks that appear in at least one response are stored, and only pairs that actually contributed, so the
+    # array grows with the actual history and not with repositories × authors.
+    def __init__(self, contributors: dict):
+        # contributors is {repo: /stats/contributors response}
+        self.repos = list(contributors)
+        self.authors = list(dict.fromkeys(author['author']['login']
+                                          for response in contributors.values() for author in response))
+
+        author_index = {login: i for i, login in enumerate(self.authors)}
+
+        # Pairs of a repository are contiguous rows, its authors in the order GitHub listed them
+        self.repo_rows = {}
+        self.repo_authors = {}
+        pair_authors = []
+        totals = []
+        counts = []
+
+        for repo, response in contributors.items():
+            self.repo_authors[repo] = [author_index[author['author']['login']] for author in response]
+            self.repo_rows[repo] = slice(len(pair_authors), len(pair_authors) + len(response))
+            pair_authors += self.repo_authors[repo]
+            totals += [author['total'] for author in response]
+            counts += [len(author['weeks']) for author in response]
+
+        # Author of each pair and the all-time totals GitHub computed
+        self.pair_authors = np.array(pair_authors, dtype=np.int64)
+        self.totals = np.array(totals, dtype=np.int64)
+
+        # Pairs sorted by author, and where the pairs of each author start: sums by author are np.add.reduceat over
+        # them. Every author has at least one pair.
+        self._author_order = np.argsort(self.pair_authors, kind='stable')
+        self._author_starts = np.searchsorted(self.pair_authors[self._author_order], np.arange(len(self.authors)))
+
+        # Every week of every author flattened into one (week, commits, additions, deletions) row, with the pair it
+        # belongs to alongside: this is the only pass over the weeks done in Python
+        rows = np.fromiter(chain.from_iterable(map(_week_fields, chain.from_iterable(
+                           author['weeks'] for response in contributors.values() for author in response))),
+                           dtype=np.int64).reshape(-1, 4)
+        pairs = np.repeat(np.arange(len(pair_authors), dtype=np.int64), counts)
+
+        self.weeks, w = np.unique(rows[:, 0], return_inverse=True)
+        self.activity = np.zeros((3, len(pair_authors), len(self.weeks)), dtype=np.int32)
+        self.activity[:, pairs, w.reshape(-1)] = rows[:, 1:].T
+
+    def _rows(self, repo: str = None) -> slice:
+        return slice(None) if repo is None else self.repo_rows[repo]
+
+    def _by_author(self, values: np.ndarray, repo: str = None) -> np.ndarray:
+        # Turn an array indexed by pair on axis 1 (the pairs of repo, or all of them) into one indexed by author
+        if repo is not None:
+            result = np.zeros(values.shape[:1] + (len(self.authors),) + values.shape[2:], dtype=np.int64)
+            result[:, self.pair_authors[self.repo_rows[repo]]] = values
+            return result
+
+        if len(self.authors) == 0:
+            return np.zeros(values.shape, dtype=np.int64)
+
+        return np.add.reduceat(values[:, self._author_order], self._author_starts, axis=1)
+
+    def _weeks_between(self, since: int = None, until: int = None) -> slice:
+        # Weeks starting after since and up to until, both UNIX timestamps: None means no limit
+        start = 0 if since is None else np.searchsorted(self.weeks, since, side='right')
+        end = len(self.weeks) if until is None else np.searchsorted(self.weeks, until, side='right')
+        return slice(start, end)
+
+    def window(self, since: int = None, until: int = None, repo: str = None) -> np.ndarray:
+        # Commits, additions and deletions of each author in a time window, as a fields × authors array,
+        # for a single repository or for all of them
+        weeks = self.activity[:, self._rows(repo), self._weeks_between(since, until)]
+        return self._by_author(weeks.sum(axis=2, dtype=np.int64), repo)
+
+    def periods(self, edges: list, repo: str = None) -> np.ndarray:
+        # Commits, additions and deletions of each author in consecutive periods (months, quarters, academic years...)
+        # as a fields × authors × periods array. edges are the UNIX timestamps where the periods start, plus the end of
+        # the last one: a week belongs to a period if it starts in [edge, next edge).
+        activity = self.activity[:, self._rows(repo)]
+        cumulative = np.concatenate([np.zeros(activity.shape[:2] + (1,), dtype=np.int64),
+                                     activity.cumsum(axis=2, dtype=np.int64)], axis=2)
+        bounds = np.searchsorted(self.weeks, np.array(edges, dtype=np.int64), side='left')
+        return self._by_author(cumulative[:, :, bounds[1:]] - cumulative[:, :, bounds[:-1]], repo)
+
+    def by_author(self, values: np.ndarray, repo: str = None) -> dict:
+        # Turn an array indexed by author into {login: value}, for the authors of repo or for all of them
+        authors = range(len(self.authors)) if repo is None else self.repo_authors[repo]
+        return {self.authors[a]: int(values[a]) for a in authors}
+
+    def total(self, repo: str = None) -> dict:
+        # All-time commits by author, as computed by GitHub
+        return self.by_author(self._by_author(self.totals[self._rows(repo)][np.newaxis], repo)[0], repo)
+
+
+def year_edges(first: int, last: int) -> list:
+    # Start of every calendar year from the one of first to the one after last, for ActivityMatrix.periods
+    return [int(datetime(year, 1, 1).timestamp()) for year in
+            range(datetime.fromtimestamp(first).year, datetime.fromtimestamp(last).year + 2)]
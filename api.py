@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import heapq
+import atexit
+import requests
+from threading import Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+
+import metrics
+from http_cache import HttpCache
+from governor import RateLimitGovernor, raise_rate_limited_exception
+from config import owner, dev_mode, token, extra_tokens, api_workers, stats_deadline, rate_limit_max_wait, \
+                   http_cache_file, http_cache_ttl, http_cache_max_size
+
+url_api = "https://api.github.com"
+
+# Backoff for repositories whose statistics are still being computed by GitHub (202 Accepted)
+retry_delay = 2
+retry_max_delay = 30
+
+_session = None
+_cache = None
+
+# Collectors running at the same time (see PhaseScheduler) print their progress under this lock, so that their lines
+# do not end up mixed
+print_lock = Lock()
+
+# Collectors running at the same time (see PhaseScheduler) share the same api_workers requests in flight
+_in_flight = BoundedSemaphore(api_workers)
+
+governor = RateLimitGovernor([t for t in [token] + extra_tokens if t != "YOUR TOKEN HERE"], rate_limit_max_wait,
+                             print_lock)
+
+
+def full_name(repo: str) -> str:
+    # Repositories of owner are named by their name alone, the ones of a batch run (see --batch) as owner/name,
+    # since a batch run covers several owners. GitHub does not allow slashes in names.
+    return repo if '/' in repo else f'{owner}/{repo}'
+
+
+def get_session() -> requests.Session:
+    # A single pooled session is shared by every collector, so connections (and their TLS handshakes) are reused
+    # across requests and repositories instead of being opened again for each call
+    global _session
+
+    if _session is None:
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=api_workers)
+        _session = requests.Session()
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+
+    return _session
+
+
+def get_cache():
+    # The HTTP cache is opened on first use and closed (and trimmed) when the program exits
+    global _cache
+
+    if _cache is None and http_cache_file:
+        _cache = HttpCache(http_cache_file, http_cache_ttl, http_cache_max_size)
+        atexit.register(_cache.close)
+
+    return _cache
+
+
+def _send(url: str, header: dict, payload: dict = None) -> requests.Response:
+    # Authenticate with a token chosen by the governor, waiting for (or switching away from) rate-limited ones.
+    # Requests with a payload are POSTed as JSON, the others are GET requests.
+    started = time.time()
+
+    while True:
+        pat = governor.acquire(started)
+        auth = {'Authorization': f'token {pat}'} if pat else {}
+
+        with _in_flight, metrics.timer('http_request_seconds'):
+            if payload is None:
+                response = get_session().get(url, headers={**header, **auth})
+            else:
+                response = get_session().post(url, json=payload, headers={**header, **auth})
+
+        metrics.count('http_requests_total', status=str(response.status_code))
+        metrics.count('http_received_bytes_total', len(response.content))
+
+        if not governor.update(pat, response):
+            return response
+
+
+def get(url: str, header: dict) -> requests.Response:
+    cache = get_cache()
+    cached = cache.lookup(url) if cache else None
+
+    if cached is None:
+        response = _send(url, header)
+    else:
+        validators, headers, body = cached
+        response = _send(url, {**header, **validators})
+
+        # Not modified: answer with the stored response, so that callers do not need to know about the cache
+        if response.status_code == 304:
+            cache.touch(url)
+            response.status_code = 200
+            response.headers.update(headers)
+            response._content = body
+            return response
+
+    if cache and response.status_code == 200:
+        cache.store(url, response)
+
+    return response
+
+
+def post(url: str, payload: dict, header: dict) -> requests.Response:
+    # POST requests are not cached, GitHub only sends validators for GET requests
+    return _send(url, header, payload)
+
+
+def _decode(response: requests.Response):
+    # Statistics endpoints answer 204 with an empty body for empty repositories, an empty dict behaves like an
+    # empty list or an empty language breakdown for all the callers
+    return response.json() if response.content else {}
+
+
+def get_all(urls: list, header: dict) -> list:
+    # Fetch a list of URLs concurrently, responses are returned in the same order as the URLs
+    with ThreadPoolExecutor(max_workers=api_workers) as pool:
+        return list(pool.map(lambda url: get(url, header), urls))
+
+
+def ping(repos: list, endpoints: list, header: dict):
+    # Ask GitHub to (re)compute statistics by requesting them, without waiting for them to be ready: requests go
+    # out concurrently, bodies are neither parsed nor cached and 202 responses are not retried.
+    urls = {f'{url_api}/repos/{full_name(repo)}/{endpoint}': f'{repo}/{endpoint}'
+            for repo in repos for endpoint in endpoints}
+    done = 0
+
+    def send(url: str):
+        nonlocal done
+        response = _send(url, header)
+        response.close()
+
+        with print_lock:
+            done += 1
+            print(f"\t{done}/{len(urls)} - {urls[url]} - {response.status_code}")
+
+        return response.status_code
+
+    with ThreadPoolExecutor(max_workers=api_workers) as pool:
+        if 403 in pool.map(send, list(urls)):
+            raise_rate_limited_exception()
+
+
+def fetch_all(repos: list, endpoint: str, header: dict, cache_suffix: str, failure: str = 'Awaiting new data...',
+              deadline: float = stats_deadline, on_result=None) -> dict:
+    # Fetch {url_api}/repos/{full_name(repo)}/{endpoint} for every repository, at most api_workers requests at a time.
+    # Returns {repo: (status_code, json)} in the same order as repos. In dev mode responses are cached in repo-stats
+    # as {repo}{cache_suffix}.json (owner@name.json for owner/name) and cached responses are reported with a 200
+    # status code.
+    # Repositories answering 202 (statistics still being computed) are put on a backoff queue and requested again
+    # while the others are being fetched, until they are ready or `deadline` seconds have passed since the start.
+    # on_result(repo, status_code, json) is called for each repository as soon as its result is final, so that
+    # results are kept even if a later request fails (e.g. because of the rate limit).
+    results = {}
+    to_fetch = []
+    done = 0
+    give_up_at = time.monotonic() + deadline
+
+    if dev_mode:
+        try:
+            os.mkdir('repo-stats')
+        except FileExistsError:
+            pass
+
+    def cache_path(repo: str) -> str:
+        return os.path.join('repo-stats', f"{repo.replace('/', '@')}{cache_suffix}.json")
+
+    def report(repo: str, message: str):
+        nonlocal done
+
+        with print_lock:
+            done += 1
+            print(f"\t{done}/{len(repos)} - {repo}/{endpoint} - {message}")
+
+        if on_result:
+            on_result(repo, *results[repo])
+
+    for repo in repos:
+        if dev_mode and os.path.isfile(cache_path(repo)):
+            with open(cache_path(repo), 'r') as f:
+                results[repo] = (200, json.load(f))
+            report(repo, 'Using cached result...')
+        else:
+            to_fetch.append(repo)
+
+    def fetch(repo: str):
+        response = get(f'{url_api}/repos/{full_name(repo)}/{endpoint}', header)
+
+        if response.status_code == 403:
+            return response.status_code, None
+
+        data = _decode(response)
+
+        # If in devmode, cache the response in case it does not yet exist
+        if dev_mode and response.status_code != 202:
+            with open(cache_path(repo), 'w') as f:
+                json.dump(data, f)
+
+        return response.status_code, data
+
+    with ThreadPoolExecutor(max_workers=api_workers) as pool:
+        running = {pool.submit(fetch, repo): (repo, 0) for repo in to_fetch}
+        waiting = []  # heap of (retry_at, repo, attempt)
+
+        while running or waiting:
+            while waiting and waiting[0][0] <= time.monotonic():
+                _, repo, attempt = heapq.heappop(waiting)
+                running[pool.submit(fetch, repo)] = (repo, attempt)
+
+            timeout = max(0, waiting[0][0] - time.monotonic()) if waiting else None
+
+            if not running:
+                time.sleep(timeout)
+                continue
+
+            finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                repo, attempt = running.pop(future)
+                status_code, data = future.result()
+
+                if status_code == 403:
+                    raise_rate_limited_exception()
+
+                if status_code == 202:
+                    delay = min(retry_delay * 2 ** attempt, retry_max_delay)
+
+                    if time.monotonic() + delay <= give_up_at:
+                        heapq.heappush(waiting, (time.monotonic() + delay, repo, attempt + 1))
+                        continue
+
+                results[repo] = (status_code, data)
+                report(repo, 'OK' if status_code == 200 else failure)
+
+    incomplete = [repo for repo in repos if results[repo][0] == 202]
+    if incomplete:
+        with print_lock:
+            print(f"\n\tGitHub is still computing statistics for {len(incomplete)} repositories after {deadline}s: "
+                  f"{', '.join(incomplete)}")
+
+    return {repo: results[repo] for repo in repos}
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+
+# Benchmark of the whole pipeline against a synthetic organization: local git repositories generated from a seed and
+# a local stand-in for GitHub's API serving matching responses, so that runs are repeatable and do not need network
+# access. Each phase of main.py is timed and compared with the previous results of other commits, then the whole
+# pipeline as collect_all_stats runs it, with the phases at the same time.
+
+import os
+import io
+import sys
+import json
+import atexit
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import threading
+import contextlib
+from datetime import datetime
+from subprocess import run, DEVNULL
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import api
+import main
+import graphql_api
+from config import owner
+
+# File kinds of the synthetic repositories: extension, language as GitHub and cloc name it, comment prefix
+file_kinds = {
+    'py': ('.py', 'Python', '#'),
+    'js': ('.js', 'JavaScript', '//'),
+    'c': ('.c', 'C', '//'),
+    'md': ('.md', 'Markdown', None),
+    'bin': ('.bin', None, None),
+}
+
+# A week in seconds, statistics are weekly
+week = 7 * 24 * 3600
+
+
+def _git(args: list, cwd: str):
+    env = {**os.environ, 'GIT_AUTHOR_NAME': 'sardina', 'GIT_AUTHOR_EMAIL': 'sardina@example.com',
+           'GIT_COMMITTER_NAME': 'sardina', 'GIT_COMMITTER_EMAIL': 'sardina@example.com'}
+    run(['git'] + args, cwd=cwd, env=env, stdout=DEVNULL, stderr=DEVNULL, check=True)
+
+
+def _file_content(rng: random.Random, kind: str, lines: int) -> bytes:
+    extension, language, comment = file_kinds[kind]
+
+    if language is None:
+        return bytes(rng.getrandbits(8) for _ in range(lines * 16)) + b'\0'
+
+    content = []
+    for i in range(lines):
+        roll = rng.random()
+
+        if roll < 0.15:
+            content.append('')
+        elif roll < 0.3 and comment:
+            content.append(f'{comment} comment {i}')
+        else:
+            content.append(f'{"    " * rng.randint(0, 3)}value_{i} = {rng.randint(0, 1 << 30)}')
+
+    return ('\n'.join(content) + '\n').encode()
+
+
+def _allow_partial_clones(repo_path: str):
+    # Repositories are cloned through file:// URLs, so that shallow and partial clones are actually made: the local end
+    # has to allow blob filters and fetching the blobs left out later on, as GitHub does. This is read from the
+    # repository itself, git does not pass GIT_CONFIG_* on to the upload-pack serving a local clone.
+    _git(['config', 'uploadpack.allowFilter', 'true'], repo_path)
+    _git(['config', 'uploadpack.allowAnySHA1InWant', 'true'], repo_path)
+
+
+def generate_org(path: str, repos: int, files: int, lines: int, mix: dict, seed: int) -> dict:
+    # Generate `repos` git repositories with `files` files each, of about `lines` lines, of the kinds in mix
+    # ({kind: weight}). Returns the description of the organization the mock API serves: {repo: {language: bytes}}.
+    # Repositories are only generated again if the parameters changed since the last time.
+    parameters = {'repos': repos, 'files': files, 'lines': lines, 'mix': mix, 'seed': seed}
+    description_path = os.path.join(path, 'org.json')
+
+    if os.path.isfile(description_path):
+        with open(description_path) as f:
+            description = json.load(f)
+
+        if description['parameters'] == parameters:
+            # Organizations generated before the repositories allowed partial clones
+            for repo in description['languages']:
+                _allow_partial_clones(os.path.join(path, repo))
+
+            return description['languages']
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    languages = {}
+
+    for r in range(repos):
+        repo = f'repo{r:04d}'
+        repo_path = os.path.join(path, repo)
+        os.makedirs(repo_path)
+        languages[repo] = {}
+
+        for f in range(files):
+            kind = rng.choices(kinds, weights)[0]
+            content = _file_content(rng, kind, max(1, int(rng.gauss(lines, lines / 3))))
+            name = os.path.join(f'dir{f % 10}', f'file{f}{file_kinds[kind][0]}')
+            os.makedirs(os.path.join(repo_path, os.path.dirname(name)), exist_ok=True)
+
+            with open(os.path.join(repo_path, name), 'wb') as file:
+                file.write(content)
+
+            language = file_kinds[kind][1]
+            if language:
+                languages[repo][language] = languages[repo].get(language, 0) + len(content)
+
+        _git(['init', '-q'], repo_path)
+        _allow_partial_clones(repo_path)
+        _git(['add', '-A'], repo_path)
+        _git(['commit', '-q', '-m', 'Synthetic repository'], repo_path)
+
+        print(f"\t{r + 1}/{repos} - {repo} - generated")
+
+    with open(description_path, 'w') as f:
+        json.dump({'parameters': parameters, 'languages': languages}, f)
+
+    return languages
+
+
+class MockGitHub(ThreadingHTTPServer):
+    # Stand-in for the endpoints sardina uses: the repository listing (paginated, with a Link header), the statistics
+    # endpoints, which answer 202 to the first request for a share of the repositories like GitHub does while it
+    # computes them, /languages and the GraphQL listing of graphql_api (paginated by cursor, with the languages).
+    # Every response carries rate limit headers.
+    def __init__(self, languages: dict, accepted: float, rate_limit: int, seed: int):
+        super().__init__(('127.0.0.1', 0), _MockHandler)
+        self.languages = languages
+        self.repos = sorted(languages)
+        self.rate_limit = rate_limit
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.now = int(time.time()) // week * week
+        rng = random.Random(seed)
+        self.pending = {(repo, endpoint) for repo in self.repos
+                        for endpoint in ['stats/commit_activity', 'stats/contributors'] if rng.random() < accepted}
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def contributors(self, repo: str) -> list:
+        rng = random.Random(repo)
+        authors = []
+
+        for a in range(rng.randint(1, 8)):
+            weeks = [{'w': self.now - w * week, 'a': rng.randint(0, 200), 'd': rng.randint(0, 100),
+                      'c': rng.randint(0, 5)} for w in range(rng.randint(10, 260), -1, -1)]
+            authors.append({'author': {'login': f'user{a}'}, 'total': sum(w['c'] for w in weeks), 'weeks': weeks})
+
+        return authors
+
+    def commit_activity(self, repo: str) -> list:
+        rng = random.Random(repo)
+        return [{'week': self.now - w * week, 'total': rng.randint(0, 20), 'days': [0] * 7} for w in range(51, -1, -1)]
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body, headers: dict = None):
+        server = self.server
+        data = json.dumps(body).encode()
+
+        with server.lock:
+            server.requests += 1
+            remaining = max(0, server.rate_limit - server.requests)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', '"' + hashlib.sha1(data).hexdigest() + '"')
+        self.send_header('X-RateLimit-Limit', str(server.rate_limit))
+        self.send_header('X-RateLimit-Remaining', str(remaining))
+        self.send_header('X-RateLimit-Reset', str(int(time.time()) + 3600))
+
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+
+        if parts[0] in ('orgs', 'users'):
+            query = parse_qs(url.query)
+            per_page = int(query.get('per_page', ['30'])[0])
+            page = int(query.get('page', ['1'])[0])
+            pages = max(1, -(-len(server.repos) // per_page))
+            listing = [{'name': repo, 'archived': False, 'disabled': False, 'pushed_at': '2020-01-01T00:00:00Z'}
+                       for repo in server.repos[(page - 1) * per_page:page * per_page]]
+            base = f'{server.url}{url.path}?per_page={per_page}'
+            return self._send(200, listing, {'Link': f'<{base}&page={min(page + 1, pages)}>; rel="next", '
+                                                     f'<{base}&page={pages}>; rel="last"'} if pages > 1 else None)
+
+        if parts[0] != 'repos' or len(parts) < 4 or parts[2] not in server.languages:
+            return self._send(404, {'message': 'Not Found'})
+
+        repo, endpoint = parts[2], '/'.join(parts[3:])
+
+        if endpoint.startswith('stats/'):
+            with server.lock:
+                pending = (repo, endpoint) in server.pending
+                server.pending.discard((repo, endpoint))
+
+            if pending:
+                return self._send(202, {})
+
+        if endpoint == 'stats/commit_activity':
+            return self._send(200, server.commit_activity(repo))
+
+        if endpoint == 'stats/contributors':
+            return self._send(200, server.contributors(repo))
+
+        if endpoint == 'languages':
+            return self._send(200, server.languages[repo])
+
+        self._send(404, {'message': 'Not Found'})
+
+    def do_POST(self):
+        # Only the repositoryOwner.repositories query of graphql_api is answered, cursors are positions in the listing
+        server = self.server
+
+        if urlparse(self.path).path != '/graphql':
+            return self._send(404, {'message': 'Not Found'})
+
+        variables = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))['variables']
+        start = int(variables['cursor'] or 0)
+        end = min(start + variables['pageSize'], len(server.repos))
+
+        if variables['owner'] != owner:
+            return self._send(200, {'data': {'repositoryOwner': None}})
+
+        nodes = [{'name': repo, 'isArchived': False, 'isDisabled': False, 'pushedAt': '2020-01-01T00:00:00Z',
+                  'languages': {'edges': [{'size': size, 'node': {'name': language}} for language, size in
+                                          sorted(server.languages[repo].items(), key=lambda item: -item[1])]}}
+                 for repo in server.repos[start:end]]
+
+        self._send(200, {'data': {'repositoryOwner': {'repositories': {
+            'pageInfo': {'hasNextPage': end < len(server.repos), 'endCursor': str(end)}, 'nodes': nodes}}}})
+
+
+def _time_phases(phases: list, verbose: bool) -> dict:
+    # Run (name, function) phases in order, returns {name: seconds}. Their output is hidden unless verbose.
+    timings = {}
+
+    for name, phase in phases:
+        output = io.StringIO()
+        started = time.perf_counter()
+
+        with contextlib.redirect_stdout(sys.stdout if verbose else output):
+            phase()
+
+        timings[name] = time.perf_counter() - started
+        print(f"\t{name}: {timings[name]:.3f}s")
+
+    return timings
+
+
+def run_pipeline(work_dir: str, with_cloc: bool, with_graphs: bool, warm: bool, verbose: bool) -> dict:
+    # Run every phase of main.py once from work_dir, where clones, caches and output end up, one after the other. Then
+    # run all of them again with collect_all_stats, from a directory of its own so that it starts from scratch too
+    # unless warm.
+    header = {'Accept': 'application/vnd.github.v3+json'}
+    state = {}
+
+    def lines(use_cloc: bool):
+        state['lines'], state['cloc_language_repo'], state['cloc_language_total'] = main.get_lines_stats(
+            state['repos'], use_cloc)
+
+    phases = [
+        ('get_repos', lambda: state.update(repos=list(main.get_repos(header)))),
+        ('get_anonymous_commits_stats',
+         lambda: state.update(commits=main.get_anonymous_commits_stats(state['repos'], header))),
+        ('get_contributors_commits_stats',
+         lambda: state.update(contributors=main.get_contributors_commits_stats(state['repos'], header))),
+        ('get_language_stats', lambda: state.update(languages=main.get_language_stats(state['repos'], header))),
+        ('get_lines_stats (wc)', lambda: lines(False)),
+    ]
+
+    if with_cloc:
+        phases.append(('get_lines_stats (cloc)', lambda: lines(True)))
+
+    phases.append(('print_all_stats', lambda: main.print_all_stats(
+        state['repos'], state['commits'], state['lines'], state['contributors'],
+        state['cloc_language_total'] if with_cloc else state['languages'][0],
+        state['cloc_language_repo'] if with_cloc else state['languages'][1], with_cloc, with_graphs)))
+
+    def collect_all():
+        if not warm:
+            _reset_http_cache()
+
+        graphql_api.forget_repositories()
+        os.makedirs('scheduled', exist_ok=True)
+        os.chdir('scheduled')
+
+        try:
+            main.collect_all_stats(header, with_cloc, True, True, True, with_graphs, full=True)
+        finally:
+            os.chdir(work_dir)
+
+    phases.append(('collect_all_stats', collect_all))
+
+    # The GraphQL listing is kept for the whole process, every run has to query it again
+    graphql_api.forget_repositories()
+
+    cwd = os.getcwd()
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+
+    try:
+        return _time_phases(phases, verbose)
+    finally:
+        os.chdir(cwd)
+
+
+def _reset_http_cache():
+    # The HTTP cache stays open for the whole process, close it so that the next run starts with an empty one
+    if api._cache is not None:
+        atexit.unregister(api._cache.close)
+        api._cache.close()
+        api._cache = None
+
+
+def _commit() -> str:
+    head = run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip() or 'unknown'
+    dirty = run(['git', 'diff', '--quiet', 'HEAD', '--', '*.py'], stdout=DEVNULL, stderr=DEVNULL).returncode != 0
+    return head + ('-dirty' if dirty else '')
+
+
+def report(results: list, current: dict, threshold: float) -> bool:
+    # Compare the current results with the latest ones of another commit with the same parameters.
+    # Returns whether any phase got slower by more than threshold (a fraction).
+    previous = [result for result in results
+                if result['parameters'] == current['parameters'] and result['commit'] != current['commit']]
+
+    if not previous:
+        print("\nNo previous results with the same parameters to compare with")
+        return False
+
+    baseline = previous[-1]
+    regressed = False
+    print(f"\nCompared with {baseline['commit']} ({baseline['date']}):")
+
+    for phase, seconds in current['phases'].items():
+        if phase not in baseline['phases']:
+            print(f"\t{phase}: {seconds:.3f}s (new)")
+            continue
+
+        before = baseline['phases'][phase]
+        change = (seconds - before) / before if before > 0 else 0
+        slower = change > threshold
+        regressed = regressed or slower
+        print(f"\t{phase}: {before:.3f}s -> {seconds:.3f}s ({change:+.1%}){' REGRESSION' if slower else ''}")
+
+    return regressed
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark sardina against a synthetic organization")
+    parser.add_argument('--repos', type=int, default=20, help='Number of repositories to generate.')
+    parser.add_argument('--files', type=int, default=50, help='Files per repository.')
+    parser.add_argument('--lines', type=int, default=200, help='Average lines per file.')
+    parser.add_argument('--mix', type=str, default='py=4,js=2,c=2,md=1,bin=1',
+                        help=f'Weights of the file kinds, among {", ".join(file_kinds)}.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generated data.')
+    parser.add_argument('--accepted', type=float, default=0.3,
+                        help='Share of statistics answered with 202 on the first request.')
+    parser.add_argument('--rate-limit', type=int, default=5000, help='Rate limit announced by the mock API.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs to make, the fastest one is kept for each phase.')
+    parser.add_argument('--warm', action='store_true',
+                        help='Keep clones and caches between runs, instead of starting each one from scratch.')
+    parser.add_argument('--cloc', action='store_true', help='Time line counting with cloc too.')
+    parser.add_argument('--graphs', action='store_true', help='Generate graphs in print_all_stats.')
+    parser.add_argument('--graphql', action='store_true', help='List repositories and languages through GraphQL.')
+    parser.add_argument('--dir', type=str, default='benchmark', help='Where repositories and runs are kept.')
+    parser.add_argument('--results', type=str, default='benchmark_results.json',
+                        help='File where the results of every commit are kept.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slowdown of a phase, as a fraction, reported as a regression.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the output of the phases.')
+    args = parser.parse_args()
+
+    mix = {kind: float(weight) for kind, weight in (item.split('=') for item in args.mix.split(','))}
+
+    if any(kind not in file_kinds for kind in mix):
+        raise Exception(f"Unknown file kind in --mix, use {', '.join(file_kinds)}")
+
+    if args.cloc and shutil.which('cloc') is None:
+        main.raise_cloc_not_installed_exception()
+
+    org_dir = os.path.abspath(os.path.join(args.dir, 'org', owner))
+    print(f"Generating {args.repos} repositories...")
+    languages = generate_org(org_dir, args.repos, args.files, args.lines, mix, args.seed)
+
+    # Point every collector to the local stand-ins, retries of 202s are made faster than GitHub needs
+    api.retry_delay = 0.05
+    main.url_clone = 'file://' + os.path.dirname(org_dir)
+    main.use_graphql = args.graphql
+
+    timings = []
+
+    for i in range(args.repeat):
+        server = MockGitHub(languages, args.accepted, args.rate_limit, args.seed + i)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        api.url_api = main.url_api = server.url
+        graphql_api.url_graphql = f'{server.url}/graphql'
+
+        work_dir = os.path.abspath(os.path.join(args.dir, 'run'))
+        if not args.warm:
+            _reset_http_cache()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        print(f"\nRun {i + 1}/{args.repeat}:")
+        timings.append(run_pipeline(work_dir, args.cloc, args.graphs, args.warm, args.verbose))
+        print(f"\t{server.requests} requests")
+        server.shutdown()
+        server.server_close()
+
+    current = {
+        'commit': _commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'parameters': {key: getattr(args, key) for key in
+                       ['repos', 'files', 'lines', 'mix', 'seed', 'accepted', 'rate_limit', 'warm', 'cloc', 'graphs',
+                        'graphql']},
+        'phases': {phase: min(run_timings[phase] for run_timings in timings) for phase in timings[0]},
+    }
+
+    results = []
+    if os.path.isfile(args.results):
+        with open(args.results) as f:
+            results = json.load(f)
+
+    regressed = report(results, current, args.threshold)
+
+    # Only the latest results of each commit are kept
+    results = [result for result in results
+               if not (result['commit'] == current['commit'] and result['parameters'] == current['parameters'])]
+    results.append(current)
+
+    with open(args.results, 'w') as f:
+        json.dump(results, f, indent=1)
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main_benchmark()
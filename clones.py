@@ -0,0 +1,156 @@
+import os
+import shutil
+from subprocess import run, DEVNULL
+
+import api
+import metrics
+
+clones_dir = 'repos'
+
+
+def clone_path(repo: str, bare: bool) -> str:
+    # Bare mirrors and working tree clones of the same repository live side by side, as in <repo>.git and <repo>.
+    # Repositories named owner/name in a batch run are kept as owner@name, GitHub does not allow @ in names.
+    name = repo.replace('/', '@')
+    return os.path.join(clones_dir, f'{name}.git' if bare else name)
+
+
+def history_path(repo: str) -> str:
+    # Where the history clone of a repository is kept, see prepare_history_clone. + is not allowed in names either.
+    return os.path.join(clones_dir, f"{repo.replace('/', '@')}+history.git")
+
+
+def _git(args: list, cwd: str = None) -> bool:
+    metrics.count('subprocesses_total', command='git')
+    return run(['git'] + args, cwd=cwd, stdout=DEVNULL, stderr=DEVNULL).returncode == 0
+
+
+def _git_output(args: list, cwd: str = None) -> str:
+    metrics.count('subprocesses_total', command='git')
+    return run(['git'] + args, cwd=cwd, capture_output=True, text=True).stdout.strip()
+
+
+def _clone(url: str, path: str, bare: bool, shallow: bool, blob_limit: int, sparse: list) -> bool:
+    if not shallow:
+        if bare:
+            # Like --mirror, but only for branches: GitHub would also send every pull request ref
+            return _git(['clone', '--bare', url, path]) and \
+                   _git(['config', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*'], path)
+
+        return _git(['clone', url, path])
+
+    # Only the tree of the last commit of the default branch is ever counted, so that is all that is transferred
+    if bare:
+        # Blobs bigger than blob_limit are left on GitHub, see missing_blobs in sloc.py. Later fetches apply the same
+        # filter. Bare clones have no fetch refspec by default, HEAD is all that is needed.
+        blob_filter = [f'--filter=blob:limit={blob_limit}'] if blob_limit else []
+        return _git(['clone', '--bare', '--depth', '1', '--single-branch', *blob_filter, url, path]) and \
+               _track_head(path)
+
+    # cloc needs every file it counts, whatever its size: no blob is transferred by the clone itself, the checkout
+    # fetches the ones the sparse checkout keeps in a single request
+    return _git(['clone', '--depth', '1', '--filter=blob:none', '--sparse', url, path]) and \
+           _sparse_checkout(path, sparse)
+
+
+def _track_head(path: str) -> bool:
+    # Make git fetch update the default branch of a bare clone, and nothing else
+    return _git(['config', 'remote.origin.fetch', f'+HEAD:{_git_output(["symbolic-ref", "HEAD"], path)}'], path)
+
+
+def _sparse_checkout(path: str, sparse: list) -> bool:
+    # Check out every file but the top level directories matching the sparse patterns, which are never written
+    # (nor transferred, for clones without blobs). Patterns are set again on every update, as ignored_files may
+    # have changed in the meantime.
+    return _git(['sparse-checkout', 'set', '--no-cone', '/*', *[f'!/{pattern}/' for pattern in sparse]], path)
+
+
+def prepare_clone(url: str, path: str, bare: bool, update: bool = True, shallow: bool = False,
+                  blob_limit: int = None, sparse: list = None) -> bool:
+    # Clone a repository, or bring an existing clone up to date: only the new commits are transferred. Clones that
+    # cannot be updated (e.g. corrupted by an interrupted run) are made again from scratch.
+    # Shallow clones only have the last commit, without blobs bigger than blob_limit (bare clones) or without the top
+    # level directories matching the sparse patterns (working tree clones), see _clone.
+    # Returns whether the clone is available.
+    git_dir = path if bare else os.path.join(path, '.git')
+    size = _directory_size(git_dir)
+    depth = ['--depth', '1'] if shallow else []
+
+    if os.path.isdir(path) and update:
+        if bare:
+            updated = _git(['fetch', *depth, '--prune', 'origin'], path)
+        else:
+            updated = _git(['fetch', *depth, 'origin', 'HEAD'], path) and \
+                      _git(['reset', '--hard', 'FETCH_HEAD'], path) and \
+                      (not shallow or _sparse_checkout(path, sparse or []))
+
+        if not updated:
+            shutil.rmtree(path)
+
+    if not os.path.isdir(path):
+        if not _clone(url, path, bare, shallow, blob_limit, sparse or []):
+            shutil.rmtree(path, ignore_errors=True)
+            return False
+
+    # What was transferred, roughly: packs received by a fetch can be smaller than the objects they replace
+    metrics.count('cloned_bytes_total', max(0, _directory_size(git_dir) - size))
+
+    # The modification time of the clone directory is what the least recently used eviction looks at
+    os.utime(path)
+    return True
+
+
+def prepare_history_clone(url: str, path: str, update: bool = True) -> bool:
+    # A bare clone of the commits of the default branch, without any tree or blob (--filter=tree:0): enough for git log
+    # to tell who committed when, and much smaller than a full clone. Updates only transfer the new commits.
+    # Returns whether the clone is available.
+    size = _directory_size(path)
+
+    if os.path.isdir(path) and update and not _git(['fetch', '--prune', 'origin'], path):
+        shutil.rmtree(path)
+
+    if not os.path.isdir(path):
+        if not (_git(['clone', '--bare', '--single-branch', '--filter=tree:0', url, path]) and _track_head(path)):
+            shutil.rmtree(path, ignore_errors=True)
+            return False
+
+    metrics.count('cloned_bytes_total', max(0, _directory_size(path) - size))
+    os.utime(path)
+    return True
+
+
+def _directory_size(path: str) -> int:
+    size = 0
+
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except FileNotFoundError:
+                pass
+
+    return size
+
+
+def evict_clones(max_size: int):
+    # Delete the least recently used clones until the whole cache fits in max_size bytes
+    if not os.path.isdir(clones_dir):
+        return
+
+    clones = [os.path.join(clones_dir, name) for name in os.listdir(clones_dir)]
+    clones = sorted([path for path in clones if os.path.isdir(path)], key=os.path.getmtime)
+    sizes = {path: _directory_size(path) for path in clones}
+    total = sum(sizes.values())
+
+    for path in clones:
+        if total <= max_size:
+            break
+
+        with api.print_lock:
+            print(f"\tEvicting {os.path.basename(path)} from the clone cache ({sizes[path] // (1024 * 1024)} MiB)")
+        shutil.rmtree(path)
+        total -= sizes[path]
+
+
+def remove_clones():
+    shutil.rmtree(clones_dir, ignore_errors=True)
@@ -1,10 +1,41 @@
 # general configuration
 owner = "WEEE-Open"
 is_organization = True  # True for multi-contributor organizations, False for single users
+extra_owners = {}  # more owners for --batch runs, as {"name": is_organization}, e.g. {"octocat": False}
 output_file = "stats"
 output_dir = "output"
+warehouse_file = "warehouse.sqlite3"  # every run is stored here for later reports and comparisons, None to disable
+warehouse_keep_runs = 100  # runs of each owner kept in the warehouse, older ones are deleted. None to keep all
+use_graphql = False  # list repositories and their languages with the GraphQL API, 100 per request. Needs a token
+skip_unchanged_repos = True  # reuse the stats of repositories not pushed to since the last run, from the warehouse
+commits_from_git = False  # compute commit stats with git log on local clones instead of GitHub's statistics, see README
 # your PAT generated at https://github.com/settings/tokens - see README
 token = "YOUR TOKEN HERE"
+extra_tokens = []  # more PATs, possibly from other accounts: requests are spread across all of them
+
+# performance configuration
+api_workers = 8  # maximum number of concurrent requests to GitHub's APIs
+rate_limit_max_wait = 900  # seconds to wait for a rate limit to reset before giving up, when all tokens are exhausted
+stats_deadline = 600  # seconds to keep retrying repositories whose statistics GitHub is still computing
+sloc_workers = 4  # repositories cloned and counted at the same time, each one in its own process
+graph_workers = 4  # graphs rendered at the same time, each one in its own process
+sloc_from_objects = True  # count lines with wc reading git objects from a bare clone, without checking out files
+native_cloc = False  # with --cloc, count code, comments and blanks with the built-in counter instead of cloc
+clone_cache = True  # keep cloned repositories between runs and only fetch new commits, instead of cloning again
+clone_cache_max_size = 10 * 1024 * 1024 * 1024  # bytes of clones to keep, least recently used ones are evicted
+shallow_clones = True  # clone only the last commit, without the directories ignored_files skips. Needs git 2.35+
+clone_blob_limit = 1024 * 1024  # bytes, bigger files are left out of clones and fetched when counted, None to clone all
+line_count_cache_file = "line_counts.sqlite3"  # persistent line counts of unchanged files, None to disable
+line_count_cache_ttl = 180 * 24 * 3600  # seconds after which line counts of files not seen anymore are dropped
+http_cache_file = "http_cache.sqlite3"  # persistent cache of API responses revalidated with ETags, None to disable
+http_cache_ttl = 30 * 24 * 3600  # seconds after which a cached response is fetched again from scratch
+http_cache_max_size = 64 * 1024 * 1024  # bytes of cached responses to keep, least recently used ones are evicted
+
+# daemon configuration, see --daemon
+daemon_host = "127.0.0.1"  # address the results are served on, 0.0.0.0 to make them reachable from other hosts
+daemon_port = 8080
+daemon_refresh_interval = 6 * 3600  # seconds between refreshes of the stats
+daemon_ping_interval = 3600  # seconds between pings of the statistics endpoints, so that GitHub keeps them ready
 
 # development configuration
 dev_mode = False  # False for normal use, True if you want to cache requests locally for fast development
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import traceback
+from datetime import datetime
+from threading import Thread, Lock, Event
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from config import output_dir
+
+
+class StatsDaemon:
+    # Resident mode: the HTTP session and every cache stay warm in a single long-running process, a scheduler thread
+    # refreshes the stats in the background every refresh_interval seconds (and pings GitHub's statistics endpoints
+    # every ping_interval seconds in between, so that they are ready for the next refresh), and a small HTTP server
+    # answers with the results of the last completed refresh. Requests never wait for a refresh: results are
+    # replaced all at once when a new refresh is complete.
+    def __init__(self, refresh, ping, replay, refresh_interval: float, ping_interval: float):
+        # refresh() and replay() return the dict returned by main.collect_all_stats, replay() may return None.
+        # replay() is called once at startup to serve the last stored run while the first refresh is running.
+        self.refresh_job = refresh
+        self.ping_job = ping
+        self.replay_job = replay
+        self.refresh_interval = refresh_interval
+        self.ping_interval = ping_interval
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.latest = None
+        self.status = {'refreshing': False, 'last_refresh': None, 'last_ping': None, 'last_error': None}
+
+    def _publish(self, results: dict):
+        with open(results['report'], 'rb') as f:
+            text = f.read()
+
+        metrics_path = os.path.join(output_dir, 'metrics.prom')
+        prometheus = b''
+        if os.path.isfile(metrics_path):
+            with open(metrics_path, 'rb') as f:
+                prometheus = f.read()
+
+        stats = {key: value for key, value in results.items() if key not in ['report', 'graphs']}
+        generated_at = datetime.fromtimestamp(os.path.getmtime(results['report'])).isoformat(timespec='seconds')
+
+        latest = {
+            'text': text,
+            'json': json.dumps({'generated_at': generated_at, **stats}).encode(),
+            'graphs': results['graphs'],
+            'metrics': prometheus,
+        }
+
+        with self.lock:
+            self.latest = latest
+
+    def _run(self, name: str, job):
+        # A failing job leaves the results of the previous one in place, the next one will try again
+        with self.lock:
+            self.status['refreshing'] = name == 'refresh'
+
+        try:
+            result = job()
+
+            if name != 'ping' and result is not None:
+                self._publish(result)
+
+            if name != 'replay':
+                with self.lock:
+                    self.status[f'last_{name}'] = time.time()
+
+        except Exception as e:
+            traceback.print_exc()
+            with self.lock:
+                self.status['last_error'] = f'{datetime.now().isoformat(timespec="seconds")} {name}: {e}'
+
+        finally:
+            with self.lock:
+                self.status['refreshing'] = False
+
+    def _scheduler(self):
+        self._run('replay', self.replay_job)
+        next_refresh = time.monotonic()
+        next_ping = next_refresh + self.ping_interval
+
+        while True:
+            now = time.monotonic()
+
+            if now >= next_refresh or self.wakeup.is_set():
+                self.wakeup.clear()
+                print(f"\n\n{datetime.now().isoformat(timespec='seconds')} - Refreshing stats...")
+                self._run('refresh', self.refresh_job)
+                next_refresh = time.monotonic() + self.refresh_interval
+                next_ping = time.monotonic() + self.ping_interval
+
+            elif now >= next_ping:
+                print(f"\n\n{datetime.now().isoformat(timespec='seconds')} - Pinging statistics endpoints...")
+                self._run('ping', self.ping_job)
+                next_ping = time.monotonic() + self.ping_interval
+
+            # Sleep until the next job is due, or until a refresh is requested
+            self.wakeup.wait(max(0, min(next_refresh, next_ping) - time.monotonic()))
+
+    def request_refresh(self):
+        self.wakeup.set()
+
+    def serve(self, host: str, port: int):
+        Thread(target=self._scheduler, daemon=True).start()
+
+        server = ThreadingHTTPServer((host, port), _Handler)
+        server.stats_daemon = self
+        print(f"Serving stats on http://{host}:{port}/")
+
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # GET /              the text report
+    # GET /stats.json    the stats as JSON
+    # GET /graphs/...    the graphs, as laid out in the output directory (e.g. /graphs/sardina.svg)
+    # GET /metrics       the metrics of the last refresh, in Prometheus text format
+    # GET /status        when the last refresh and ping happened, and the last error
+    # POST /refresh      start a refresh now, without waiting for it
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        daemon = self.server.stats_daemon
+        path = self.path.split('?')[0]
+
+        with daemon.lock:
+            latest = daemon.latest
+            status = dict(daemon.status)
+
+        if path == '/status':
+            return self._send(200, json.dumps(status).encode(), 'application/json')
+
+        if latest is None:
+            return self._send(503, b'The first stats are still being generated, try again later.\n', 'text/plain')
+
+        if path in ['/', '/stats.txt']:
+            return self._send(200, latest['text'], 'text/plain; charset=utf-8')
+
+        if path == '/stats.json':
+            return self._send(200, latest['json'], 'application/json')
+
+        if path == '/metrics':
+            return self._send(200, latest['metrics'], 'text/plain; version=0.0.4')
+
+        if path.startswith('/graphs/') and path.endswith('.svg') and latest['graphs']:
+            # Files outside the graph directory of the run are never served
+            root = os.path.realpath(latest['graphs'])
+            file = os.path.realpath(os.path.join(root, path[len('/graphs/'):]))
+
+            if file.startswith(root + os.sep) and os.path.isfile(file):
+                with open(file, 'rb') as f:
+                    return self._send(200, f.read(), 'image/svg+xml')
+
+        self._send(404, b'Not found\n', 'text/plain')
+
+    def do_POST(self):
+        if self.path == '/refresh':
+            self.server.stats_daemon.request_refresh()
+            return self._send(202, b'Refresh requested\n', 'text/plain')
+
+        self._send(404, b'Not found\n', 'text/plain')
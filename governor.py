@@ -0,0 +1,89 @@
+import time
+from threading import Lock
+
+
+def raise_rate_limited_exception():
+    raise Exception("You are getting rate-limited by GitHub's servers. Try again in a few minutes.") from None
+
+
+class RateLimitGovernor:
+    # Spreads requests over a pool of PATs using the rate limit headers GitHub sends with every response.
+    # Each request goes to the token with the most requests left; tokens hitting the primary limit are parked until
+    # X-RateLimit-Reset, tokens hitting a secondary limit until Retry-After. When every token is parked the governor
+    # waits for the first one to come back, or gives up once a request would have waited more than max_wait seconds.
+    def __init__(self, tokens: list, max_wait: float, print_lock: Lock = None):
+        # None stands for unauthenticated requests, used when no token is configured. Waits are announced under
+        # print_lock, shared with the progress of the collectors (see api.print_lock).
+        self.tokens = tokens or [None]
+        self.max_wait = max_wait
+        self.lock = Lock()
+        self.print_lock = print_lock or Lock()
+        self.remaining = {token: None for token in self.tokens}
+        self.blocked_until = {token: 0 for token in self.tokens}
+        self.announced = 0
+
+    def acquire(self, started: float):
+        # `started` is when the caller first tried to make the request, waits for retries of the same request add up
+        while True:
+            with self.lock:
+                now = time.time()
+                available = [token for token in self.tokens if self.blocked_until[token] <= now]
+
+                if available:
+                    # Tokens that were never used have an unknown budget, try them before the others
+                    token = max(available, key=lambda t: float('inf') if self.remaining[t] is None else self.remaining[t])
+
+                    if self.remaining[token] is not None:
+                        self.remaining[token] -= 1
+                        if self.remaining[token] <= 0:
+                            # Other threads must not pick it until a response tells otherwise
+                            self.blocked_until[token] = max(self.blocked_until[token], now + 1)
+
+                    return token
+
+                until = min(self.blocked_until.values())
+                wait = until - now
+
+                # Concurrent requests are all waiting for the same thing, tell the user only once
+                announce = self.announced != until
+                self.announced = until
+
+            if until - started > self.max_wait:
+                raise_rate_limited_exception()
+
+            if announce:
+                with self.print_lock:
+                    print(f"\tAll {len(self.tokens)} tokens are rate-limited, waiting {wait:.0f}s...")
+
+            time.sleep(wait)
+
+    def update(self, token, response) -> bool:
+        # Record the rate limit state carried by a response. Returns True if the request was rejected because of
+        # a rate limit and should be made again.
+        headers = response.headers
+        now = time.time()
+
+        with self.lock:
+            if 'x-ratelimit-remaining' in headers:
+                self.remaining[token] = int(headers['x-ratelimit-remaining'])
+
+            if response.status_code not in (403, 429):
+                if self.remaining[token] is not None and self.remaining[token] > 0:
+                    self.blocked_until[token] = 0
+                elif 'x-ratelimit-reset' in headers:
+                    self.blocked_until[token] = int(headers['x-ratelimit-reset'])
+                return False
+
+            if 'retry-after' in headers:
+                # Secondary rate limit, see https://docs.github.com/en/rest/overview/resources-in-the-rest-api#secondary-rate-limits
+                self.blocked_until[token] = now + int(headers['retry-after'])
+            elif headers.get('x-ratelimit-remaining') == '0' and 'x-ratelimit-reset' in headers:
+                self.blocked_until[token] = int(headers['x-ratelimit-reset'])
+            elif b'rate limit' in response.content.lower():
+                # Secondary rate limit without a Retry-After header, GitHub asks to wait at least one minute
+                self.blocked_until[token] = now + 60
+            else:
+                # A plain 403, not related to rate limits
+                return False
+
+            return True
@@ -0,0 +1,99 @@
+import api
+from governor import raise_rate_limited_exception
+from config import owner
+
+url_graphql = "https://api.github.com/graphql"
+
+# GitHub does not return more than 100 nodes per connection
+page_size = 100
+
+# Repositories of owner with the fields get_repos uses, plus their languages: sizes are in bytes, like the ones of
+# the REST /languages endpoint. repositoryOwner works for both organizations and users.
+_query = """
+query ($owner: String!, $pageSize: Int!, $cursor: String) {
+  repositoryOwner(login: $owner) {
+    repositories(first: $pageSize, after: $cursor, orderBy: {field: NAME, direction: ASC}) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        name
+        isArchived
+        isDisabled
+        pushedAt
+        languages(first: 100, orderBy: {field: SIZE, direction: DESC}) {
+          edges {
+            size
+            node {
+              name
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+# The listings of the current run, {owner: repositories}, see get_repositories
+_repositories = {}
+
+
+def _query_page(owner_name: str, cursor, header: dict) -> dict:
+    response = api.post(url_graphql, {'query': _query,
+                                      'variables': {'owner': owner_name, 'pageSize': page_size, 'cursor': cursor}},
+                        header)
+
+    if response.status_code == 403:
+        raise_rate_limited_exception()
+
+    # GraphQL errors come with a 200 status code, e.g. when the owner does not exist
+    if response.status_code != 200 or response.json().get('errors'):
+        raise Exception(f"GitHub GraphQL API error: {response.status_code} {response.text}")
+
+    owner_data = response.json()['data']['repositoryOwner']
+
+    if owner_data is None:
+        raise Exception(f"{owner_name} does not exist on GitHub.")
+
+    return owner_data['repositories']
+
+
+def get_repositories(header: dict, owner_name: str = owner) -> list:
+    # List every repository of an owner along with its language sizes, 100 repositories per request instead of a REST
+    # request per page of repositories and another one per repository for the languages. Pages are chained by cursor
+    # so they are fetched one after the other. The listing is fetched once per run, then reused.
+    # Repositories are returned with the same keys as in the REST API, plus 'languages': {language: bytes}.
+    if owner_name not in _repositories:
+        repositories = []
+        cursor = None
+
+        while True:
+            page = _query_page(owner_name, cursor, header)
+
+            repositories += [{'name': node['name'],
+                              'archived': node['isArchived'],
+                              'disabled': node['isDisabled'],
+                              'pushed_at': node['pushedAt'],
+                              'languages': {edge['node']['name']: edge['size'] for edge in node['languages']['edges']}}
+                             for node in page['nodes']]
+
+            if not page['pageInfo']['hasNextPage']:
+                break
+
+            cursor = page['pageInfo']['endCursor']
+
+        _repositories[owner_name] = repositories
+
+    return _repositories[owner_name]
+
+
+def forget_repositories():
+    # The next calls to get_repositories fetch the listings again, used by the daemon before each refresh
+    _repositories.clear()
+
+
+def get_languages(header: dict, owner_name: str = owner) -> dict:
+    # {repo: {language: bytes}}, taken from the repository listing without any further request
+    return {repository['name']: repository['languages'] for repository in get_repositories(header, owner_name)}
@@ -0,0 +1,283 @@
+import os
+import json
+import shutil
+import hashlib
+import matplotlib.pyplot as plot
+from matplotlib import __version__ as matplotlib_version
+from typing import List
+from threading import Lock
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
+
+import metrics
+from config import output_dir, graph_workers
+
+# Hashes of the figures generated since the figure store was last pruned, see prune_figures
+_used_hashes = set()
+
+# Figures being rendered ahead of generate_figures, {hash: future}, see render_ahead
+_rendering = {}
+_rendering_lock = Lock()
+
+
+class Graph:
+    def __init__(self,
+                 data: dict = {},
+                 minimum: int = 0,
+                 min_count: int = 0,
+                 kind: str = 'pie',
+                 legend: str = 'Default graph legend',
+                 title: str = 'Default graph title',
+                 counter: str = 'total'):
+
+        self.minimum = minimum
+        self.min_count = min_count
+        self.kind = kind
+        self.legend = legend
+        self.title = title
+        self.counter = counter
+        
+        self.data = _normalize_data(data, minimum)
+        self.count = len(self.data)
+
+    def is_suitable(self) -> bool:
+        return self.count >= self.min_count
+
+
+def __generate_chart(data: dict, minimum: int, graph_type: str, legend: str, counter: str, title: str, axis):
+    keys = data.keys()
+    values = data.values()
+    count = len(values)
+
+    total = 0
+    labels = []
+
+    for key in data:
+        total += data[key]
+    
+    for key in data:
+        percentage = (float(data[key] * 100) / float(total))
+        labels.append(f'{key} ({percentage:.2f}%)')
+
+    if counter == 'classes':
+        total_count = len(data)
+    else:
+        total_count = total
+
+    if graph_type == 'pie':
+        # Set the color map and generate a properly sized color cycle
+        colors = []
+        colormaps = {'Pastel1':9, 'Accent':8, 'Set1':9, 'tab20':20, 'tab20b':20}
+
+        for cm in colormaps:
+            cmap = plot.get_cmap(cm)
+            colors += [cmap(i/colormaps[cm]) for i in range(colormaps[cm])]
+
+        step = int(len(colors)/count)
+        axis.set_prop_cycle('color', [colors[i*step] for i in range(count)])
+
+        wedges, texts = axis.pie(values, counterclock=False, startangle=90)
+        legend = axis.legend(wedges, labels, title=legend, bbox_to_anchor=(1.01, 1), loc='upper left')
+        axis.set_aspect('equal')
+        axis.set_title(f'{title} (total: {total_count})')
+
+    elif graph_type == 'bar':
+        y = [i for i in range(count)]
+
+        bars = axis.barh(y, values, align='center')
+        axis.set_yticks(y)
+        axis.set_yticklabels(keys)
+        axis.invert_yaxis()
+        axis.set_xlabel(legend)
+        axis.set_title(f'{title} (total: {total_count})')
+
+        for bar in bars:
+            width = bar.get_width()
+            axis.annotate(str(width), xy=(width, bar.get_y() + bar.get_height() / 2), xytext=(3,0), textcoords='offset points', ha='left', va='center')
+
+
+def _normalize_data(data: dict, min_value: float):
+    result = dict(data)
+
+    # Remove summatory keys from the dictionary.
+    # The additional 'nope' is there just to avoid having to put everything in a try in case the "total" key does not exist. 
+    result.pop('total', 'nope')
+    result.pop('past_year', 'nope')
+
+    other = 0
+
+    for key in list(result.keys()):
+        if result[key] < min_value:
+            other += result.pop(key)
+
+    # Order data dictionary by size of elements
+    result = {k:v for k,v in sorted(result.items(), key=lambda x: int(x[1]), reverse=True)}
+
+    if other > 0:
+        result['other'] = other
+    
+    return result
+
+
+def repo_graphs(title: str, contributors: dict, lines, languages: dict, use_cloc: bool) -> List[Graph]:
+    # The graphs of the figure of a repository, title is its owner/name. contributors, lines and languages are its
+    # stats as print_all_stats gets them, None for the ones that were not collected.
+    graphs = []
+
+    if contributors is not None:
+        graphs.append(Graph(contributors['past_year'], 1, 2, 'bar', 'Commits',
+                            f'Commits to {title} in the last year by contributor'))
+        graphs.append(Graph(contributors['total'], 1, 2, 'bar', 'Commits', f'Commits to {title} by contributor'))
+
+    if lines is not None and use_cloc:
+        graphs.append(Graph(lines, 1, 1, 'pie', 'Type', f'Line distribution for repository {title}'))
+
+    if languages is not None:
+        graphs.append(Graph(languages, 0, 1, 'pie', 'Language', f'Language usage for repository {title}', 'classes'))
+
+    return graphs
+
+
+def generate_figure(graphs: List[Graph], path: str):
+    filtered = sorted([graph for graph in graphs if graph.is_suitable()], key=lambda x: 0 if x.kind == 'pie' else 1)
+    heights = []
+
+    # If we have no suitable graphs, return without doing nothing
+    if len(filtered) == 0:
+        return
+
+    for graph in filtered:
+        if graph.kind == 'pie':
+            heights.append(7)
+        else:
+            heights.append((0.3 * graph.count))
+
+    figure, axis = plot.subplots(len(filtered),
+                                 figsize=(12, sum(heights) + 1),
+                                 dpi=600,
+                                 gridspec_kw={'height_ratios': [h / heights[0] for h in heights]})
+
+    # We need a list for the following for loop and if len(filtered) = 1 axis is just an object. Maybe there is a better way to do this?
+    if len(filtered) == 1:
+        axis = [axis]
+
+    for i,graph in enumerate(filtered):
+        __generate_chart(graph.data, graph.minimum, graph.kind, graph.legend, graph.counter, graph.title, axis[i])
+    
+    plot.tight_layout()
+    plot.savefig(path, bbox_inches='tight')
+    plot.close(figure)
+
+
+def _figure_hash(graphs: List[Graph]) -> str:
+    # Everything a figure depends on: if the hash did not change since the last run, neither did the figure
+    content = [matplotlib_version, [[graph.kind, graph.minimum, graph.min_count, graph.legend, graph.title,
+                                     graph.counter, list(graph.data.items())] for graph in graphs]]
+    return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
+
+def _render_figure(graphs: List[Graph], path: str) -> bool:
+    # Render a figure into the figure store. Runs in a worker process, returns whether a file was written since
+    # generate_figure writes nothing when there are no suitable graphs.
+    temporary = f'{path}.{os.getpid()}.svg'
+    generate_figure(graphs, temporary)
+
+    if not os.path.isfile(temporary):
+        return False
+
+    os.replace(temporary, path)
+    return True
+
+
+def _link_figure(source: str, path: str):
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copyfile(source, path)
+
+
+def render_ahead(graphs: List[Graph], pool: ProcessPoolExecutor):
+    # Start rendering a figure into the figure store with pool before generate_figures is called with it, e.g. the
+    # figure of a repository while the stats of the others are still being collected. generate_figures then waits for
+    # it instead of rendering it again.
+    store = os.path.join(output_dir, '.figures')
+    os.makedirs(store, exist_ok=True)
+    figure_hash = _figure_hash(graphs)
+
+    with _rendering_lock:
+        if figure_hash not in _rendering and not os.path.isfile(os.path.join(store, f'{figure_hash}.svg')):
+            _rendering[figure_hash] = pool.submit(_render_figure, graphs, os.path.join(store, f'{figure_hash}.svg'))
+
+
+def generate_figures(sections: list, pool: ProcessPoolExecutor = None):
+    # Generate the figures of a list of (title, {path: (graphs, label)}) sections. Figures are rendered by a pool of
+    # processes into a store in output_dir, named after the hash of their content: figures that did not change since
+    # the last run are linked (or copied) from the store instead of being drawn again. pool is the pool to render
+    # with, a new one is started (and shut down) otherwise.
+    # The store is not pruned here, see prune_figures.
+    store = os.path.join(output_dir, '.figures')
+    os.makedirs(store, exist_ok=True)
+
+    hashes = {path: _figure_hash(graphs) for _, figures in sections for path, (graphs, _) in figures.items()}
+    _used_hashes.update(hashes.values())
+
+    with _rendering_lock:
+        ahead = {figure_hash: _rendering[figure_hash] for figure_hash in hashes.values() if figure_hash in _rendering}
+
+    to_render = {hashes[path]: graphs for _, figures in sections for path, (graphs, _) in figures.items()
+                 if hashes[path] not in ahead and not os.path.isfile(os.path.join(store, f'{hashes[path]}.svg'))}
+
+    with ProcessPoolExecutor(max_workers=graph_workers) if pool is None else nullcontext(pool) as pool:
+        rendering = {**ahead, **{figure_hash: pool.submit(_render_figure, graphs,
+                                                          os.path.join(store, f'{figure_hash}.svg'))
+                                 for figure_hash, graphs in to_render.items()}}
+
+        for title, figures in sections:
+            print(title)
+
+            unchanged = [path for path in figures if hashes[path] not in rendering]
+            waiting = {}
+            for path in figures:
+                if hashes[path] in rendering:
+                    waiting.setdefault(rendering[hashes[path]], []).append(path)
+
+            # Unchanged figures are ready right away, the others as soon as a worker is done with them
+            def ready():
+                for path in unchanged:
+                    yield path, False
+
+                for future in as_completed(waiting):
+                    future.result()
+                    for path in waiting[future]:
+                        yield path, True
+
+            for i, (path, rendered) in enumerate(ready()):
+                source = os.path.join(store, f'{hashes[path]}.svg')
+
+                # Nothing is written for figures without any suitable graph
+                if os.path.isfile(source):
+                    _link_figure(source, path)
+
+                metrics.count('figures_total', state='rendered' if rendered else 'unchanged')
+                print(f"\t{i + 1}/{len(figures)} - {figures[path][1]}{'' if rendered else ' (unchanged)'}")
+
+
+def prune_figures():
+    # Only the figures of the last run are needed to tell what changed. A run generates its figures in several calls
+    # to generate_figures (one per owner of a batch run, then the combined one), so the store is pruned once the whole
+    # run is done, keeping the figures of all of them.
+    store = os.path.join(output_dir, '.figures')
+
+    # Figures rendered ahead that no report ended up using are still written to the store first
+    with _rendering_lock:
+        wait(_rendering.values())
+
+    if os.path.isdir(store):
+        for name in os.listdir(store):
+            if name.split('.')[0] not in _used_hashes:
+                os.remove(os.path.join(store, name))
+
+    _used_hashes.clear()
+
+    with _rendering_lock:
+        _rendering.clear()
@@ -0,0 +1,179 @@
+import os
+import re
+import json
+import time
+from threading import Lock
+from subprocess import run, Popen, PIPE, DEVNULL
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import api
+import clones
+import metrics
+from config import sloc_workers
+
+# Commit statistics computed with git log on local clones instead of GitHub's statistics endpoints, which need no
+# API request, are never late (202) and are not limited to 100 contributors. Results have the same shape as the
+# responses of /stats/commit_activity and /stats/contributors, so they are handled like those.
+# Differences from GitHub: merge commits are not counted, additions and deletions are always 0 (only commits are
+# cloned, not their content) and authors are identified by the GitHub login in their noreply address, if they use
+# one, or by their name.
+
+_day = 24 * 3600
+_week = 7 * _day
+
+# Weeks start on Sunday at midnight UTC, like GitHub's: the first Sunday after the epoch is 1970-01-04
+_first_sunday = 3 * _day
+
+# 12345+login@users.noreply.github.com, or login@users.noreply.github.com for older accounts
+_noreply = re.compile(r'^(?:[0-9]+\+)?([^@]+)@users\.noreply\.github\.com$', re.IGNORECASE)
+
+# What git log found so far is stored in each history clone, so that later runs only read the new commits
+_state_file = 'sardina-commits.json'
+
+# {repo: Future of {author: {day: commits}}} of the current run, both statistics are computed from the same commits,
+# even when they are collected at the same time (see PhaseScheduler): histories being read are waited for
+_histories = {}
+_lock = Lock()
+
+
+def _week_start(timestamp: int) -> int:
+    return timestamp - (timestamp - _first_sunday) % _week
+
+
+def _git_output(args: list, path: str) -> str:
+    metrics.count('subprocesses_total', command='git')
+    return run(['git'] + args, cwd=path, capture_output=True, text=True).stdout.strip()
+
+
+def _read_commits(path: str):
+    # {author: {day: commits}} of the history clone in path, read incrementally from the commit processed by the
+    # previous run. Rewritten histories (where that commit is not an ancestor of HEAD anymore) are read again.
+    # Returns None if git log fails.
+    state_path = os.path.join(path, _state_file)
+    head = _git_output(['rev-parse', 'HEAD'], path)
+    last, counts = None, {}
+
+    if os.path.isfile(state_path):
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+
+        metrics.count('subprocesses_total', command='git')
+        if run(['git', 'merge-base', '--is-ancestor', state['head'], 'HEAD'], cwd=path,
+               stdout=DEVNULL, stderr=DEVNULL).returncode == 0:
+            last = state['head']
+            counts = {author: {int(day): commits for day, commits in days.items()}
+                      for author, days in state['counts'].items()}
+
+    if head and head != last:
+        # Streamed, so that even repositories with a very long history are never held in memory as a whole
+        metrics.count('subprocesses_total', command='git')
+        process = Popen(['git', 'log', '--no-merges', '--format=%at%x00%ae%x00%an',
+                         f'{last}..HEAD' if last else 'HEAD'], cwd=path, stdout=PIPE, stderr=DEVNULL)
+
+        for line in process.stdout:
+            timestamp, email, name = line.rstrip(b'\n').decode(errors='replace').split('\0')
+            login = _noreply.match(email)
+            days = counts.setdefault(login.group(1) if login else name, {})
+            day = int(timestamp) - int(timestamp) % _day
+            days[day] = days.get(day, 0) + 1
+
+        if process.wait() != 0:
+            return None
+
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump({'head': head, 'counts': counts}, f)
+        os.replace(state_path + '.tmp', state_path)
+
+    return counts
+
+
+def _commit_activity(counts: dict, now: int) -> list:
+    # Like /stats/commit_activity: commits of each day of the last 52 weeks, by week
+    by_day = {}
+
+    for days in counts.values():
+        for day, commits in days.items():
+            by_day[day] = by_day.get(day, 0) + commits
+
+    activity = []
+
+    for week in range(_week_start(now) - 51 * _week, _week_start(now) + 1, _week):
+        days = [by_day.get(week + i * _day, 0) for i in range(7)]
+        activity.append({'days': days, 'total': sum(days), 'week': week})
+
+    return activity
+
+
+def _contributors(counts: dict, now: int) -> list:
+    # Like /stats/contributors: commits of each author in every week from the first commit to now, authors with the
+    # least commits first
+    if not counts:
+        return []
+
+    first = _week_start(min(min(days) for days in counts.values()))
+    contributors = []
+
+    for author, days in counts.items():
+        weeks = {}
+        for day, commits in days.items():
+            weeks[_week_start(day)] = weeks.get(_week_start(day), 0) + commits
+
+        contributors.append({'author': {'login': author},
+                             'total': sum(weeks.values()),
+                             'weeks': [{'w': week, 'a': 0, 'd': 0, 'c': weeks.get(week, 0)}
+                                       for week in range(first, _week_start(now) + 1, _week)]})
+
+    return sorted(contributors, key=lambda contributor: (contributor['total'], contributor['author']['login']))
+
+
+def fetch_all(repos: list, endpoint: str, clone_url, update: bool = True, on_result=None) -> dict:
+    # Compute a statistic ('commit_activity' or 'contributors') for every repository from its history clone.
+    # clone_url(repo) is where to clone it from. Returns {repo: (status_code, json)} in the same order as repos, like
+    # api.fetch_all: repositories whose history could not be read have a 404 status code.
+    # Histories are cloned (or updated) and read by sloc_workers threads, since git does most of the work, and only
+    # once per run for both statistics. on_result is called as in api.fetch_all, once every history is read: an
+    # interrupted run reads again only the commits it had not read yet anyway.
+    os.makedirs(clones.clones_dir, exist_ok=True)
+    done = 0
+
+    with _lock:
+        to_read = [repo for repo in repos if repo not in _histories]
+        _histories.update({repo: Future() for repo in to_read})
+        histories = {repo: _histories[repo] for repo in repos}
+
+    def read(repo: str):
+        nonlocal done
+        path = clones.history_path(repo)
+
+        try:
+            with metrics.timer('repository_step_seconds', step='history', repo=repo):
+                counts = _read_commits(path) if clones.prepare_history_clone(clone_url(repo), path, update) else None
+        except Exception as e:
+            histories[repo].set_exception(e)
+            raise
+
+        histories[repo].set_result(counts)
+
+        with api.print_lock:
+            done += 1
+            print(f"\t{done}/{len(to_read)} - {repo} - {'OK' if counts is not None else 'Could not read history'}")
+
+    with ThreadPoolExecutor(max_workers=sloc_workers) as pool:
+        list(pool.map(read, to_read))
+
+    now = int(time.time())
+    compute = _commit_activity if endpoint == 'commit_activity' else _contributors
+    counts = {repo: history.result() for repo, history in histories.items()}
+    results = {repo: (200, compute(counts[repo], now)) if counts[repo] is not None else (404, None) for repo in repos}
+
+    if on_result:
+        for repo, result in results.items():
+            on_result(repo, *result)
+
+    return results
+
+
+def forget():
+    # The next call to fetch_all reads the histories again, used by the daemon before each refresh
+    with _lock:
+        _histories.clear()
@@ -0,0 +1,105 @@
+import json
+import time
+import zlib
+import sqlite3
+from threading import Lock
+
+# Response headers that are needed by the callers even when GitHub answers 304 Not Modified
+_kept_headers = ['link', 'content-type']
+
+
+class HttpCache:
+    # Persistent cache of GitHub API responses, stored in a single SQLite file with compressed bodies.
+    # Every cached URL is requested again with If-None-Match / If-Modified-Since: GitHub answers 304 without a body
+    # (and without counting it against the rate limit) when nothing changed, and the stored body is used instead.
+    def __init__(self, path: str, ttl: int, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                        "url TEXT PRIMARY KEY, "
+                        "etag TEXT, "
+                        "last_modified TEXT, "
+                        "headers TEXT NOT NULL, "
+                        "body BLOB NOT NULL, "
+                        "stored_at REAL NOT NULL, "
+                        "accessed_at REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.db.commit()
+
+    def lookup(self, url: str):
+        # Returns (validators, headers, body) for a fresh entry, None if the URL is not cached or has expired
+        with self.lock:
+            row = self.db.execute("SELECT etag, last_modified, headers, body, stored_at FROM responses WHERE url = ?",
+                                  (url,)).fetchone()
+
+        if row is None:
+            return None
+
+        etag, last_modified, headers, body, stored_at = row
+        if time.time() - stored_at > self.ttl:
+            return None
+
+        validators = {}
+        if etag:
+            validators['If-None-Match'] = etag
+        if last_modified:
+            validators['If-Modified-Since'] = last_modified
+
+        return validators, json.loads(headers), zlib.decompress(body)
+
+    def store(self, url: str, response):
+        etag = response.headers.get('etag')
+        last_modified = response.headers.get('last-modified')
+
+        # Nothing to validate against, a conditional request would never be answered with 304
+        if not (etag or last_modified):
+            return
+
+        headers = {h: response.headers[h] for h in _kept_headers if h in response.headers}
+        now = time.time()
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (url, etag, last_modified, json.dumps(headers), zlib.compress(response.content), now, now))
+            self.db.commit()
+
+    def touch(self, url: str):
+        # A 304 confirms the stored body is still current, so it counts as freshly stored and recently used
+        now = time.time()
+
+        with self.lock:
+            self.db.execute("UPDATE responses SET stored_at = ?, accessed_at = ? WHERE url = ?", (now, now, url))
+            self.db.commit()
+
+    def evict(self):
+        # Drop expired entries, then the least recently used ones until the bodies fit in max_size bytes.
+        # Returns whether anything was removed.
+        with self.lock:
+            removed = self.db.execute("DELETE FROM responses WHERE stored_at < ?",
+                                      (time.time() - self.ttl,)).rowcount > 0
+
+            size = self.db.execute("SELECT COALESCE(SUM(LENGTH(body)), 0) FROM responses").fetchone()[0]
+            if size > self.max_size:
+                for url, length in self.db.execute("SELECT url, LENGTH(body) FROM responses "
+                                                   "ORDER BY accessed_at").fetchall():
+                    self.db.execute("DELETE FROM responses WHERE url = ?", (url,))
+                    size -= length
+                    removed = True
+
+                    if size <= self.max_size:
+                        break
+
+            self.db.commit()
+
+        return removed
+
+    def close(self):
+        # Give the space freed by the eviction back to the filesystem, keeping the store compact
+        vacuum = self.evict()
+
+        with self.lock:
+            if vacuum:
+                self.db.execute("VACUUM")
+            self.db.close()
@@ -0,0 +1,205 @@
+import re
+import os
+
+# Built-in alternative to cloc (see native_cloc in config.py): languages are told apart by extension, file name or
+# shebang, and lines are split into code, comments and blanks with the comment rules of each language. Language
+# names are the ones cloc uses, so results can be compared with (and replace) the ones of cloc.
+# Like cloc, strings are not parsed: a comment marker inside a string that starts a line is taken for a comment.
+
+_c = (['//'], [('/*', '*/')])
+_hash = (['#'], [])
+
+# {language: ([line comment markers], [(block comment start, block comment end)])}
+comment_rules = {
+    'Assembly': ([';'], []),
+    'Bourne Again Shell': _hash,
+    'Bourne Shell': _hash,
+    'C': _c,
+    'C#': _c,
+    'C++': _c,
+    'C/C++ Header': _c,
+    'Clojure': ([';'], []),
+    'CMake': _hash,
+    'CSS': ([], [('/*', '*/')]),
+    'Dart': _c,
+    'Dockerfile': _hash,
+    'Elixir': _hash,
+    'Erlang': (['%'], []),
+    'F#': (['//'], [('(*', '*)')]),
+    'Go': _c,
+    'Groovy': _c,
+    'Haskell': (['--'], [('{-', '-}')]),
+    'HTML': ([], [('<!--', '-->')]),
+    'INI': ([';', '#'], []),
+    'Java': _c,
+    'JavaScript': _c,
+    'Julia': (['#'], [('#=', '=#')]),
+    'JSX': _c,
+    'Kotlin': _c,
+    'LESS': _c,
+    'Lisp': ([';'], []),
+    'Lua': (['--'], [('--[[', ']]')]),
+    'make': _hash,
+    'OCaml': ([], [('(*', '*)')]),
+    'Perl': _hash,
+    'PHP': (['//', '#'], [('/*', '*/')]),
+    'PowerShell': (['#'], [('<#', '#>')]),
+    'Python': (['#'], [('"""', '"""'), ("'''", "'''")]),
+    'R': _hash,
+    'Ruby': _hash,
+    'Rust': _c,
+    'Sass': _c,
+    'Scala': _c,
+    'SCSS': _c,
+    'SQL': (['--'], [('/*', '*/')]),
+    'Svelte': (['//'], [('/*', '*/'), ('<!--', '-->')]),
+    'Swift': _c,
+    'TeX': (['%'], []),
+    'TOML': _hash,
+    'Twig': ([], [('{#', '#}'), ('<!--', '-->')]),
+    'TypeScript': _c,
+    'Verilog-SystemVerilog': _c,
+    'VHDL': (['--'], []),
+    'Vuejs Component': (['//'], [('/*', '*/'), ('<!--', '-->')]),
+    'YAML': _hash,
+    'zsh': _hash,
+}
+
+# {lowercase extension: language}
+extensions = {
+    'asm': 'Assembly', 'bash': 'Bourne Again Shell', 'sh': 'Bourne Shell', 'c': 'C', 'cs': 'C#',
+    'cpp': 'C++', 'cc': 'C++', 'cxx': 'C++', 'c++': 'C++', 'ino': 'C++',
+    'h': 'C/C++ Header', 'hh': 'C/C++ Header', 'hpp': 'C/C++ Header', 'hxx': 'C/C++ Header',
+    'clj': 'Clojure', 'cljs': 'Clojure', 'cmake': 'CMake', 'css': 'CSS', 'dart': 'Dart', 'dockerfile': 'Dockerfile',
+    'ex': 'Elixir', 'exs': 'Elixir', 'erl': 'Erlang', 'fs': 'F#', 'fsx': 'F#', 'go': 'Go',
+    'groovy': 'Groovy', 'gradle': 'Groovy', 'hs': 'Haskell', 'html': 'HTML', 'htm': 'HTML', 'ini': 'INI',
+    'java': 'Java', 'js': 'JavaScript', 'mjs': 'JavaScript', 'cjs': 'JavaScript', 'jl': 'Julia', 'jsx': 'JSX',
+    'kt': 'Kotlin', 'kts': 'Kotlin', 'less': 'LESS', 'lisp': 'Lisp', 'el': 'Lisp', 'lua': 'Lua', 'mk': 'make',
+    'ml': 'OCaml', 'mli': 'OCaml', 'pl': 'Perl', 'pm': 'Perl', 'php': 'PHP', 'ps1': 'PowerShell',
+    'py': 'Python', 'pyw': 'Python', 'pyi': 'Python', 'r': 'R', 'rb': 'Ruby', 'rake': 'Ruby', 'rs': 'Rust',
+    'sass': 'Sass', 'scala': 'Scala', 'scss': 'SCSS', 'sql': 'SQL', 'svelte': 'Svelte', 'swift': 'Swift',
+    'tex': 'TeX', 'sty': 'TeX', 'toml': 'TOML', 'twig': 'Twig', 'ts': 'TypeScript', 'tsx': 'TypeScript',
+    'v': 'Verilog-SystemVerilog', 'sv': 'Verilog-SystemVerilog', 'vhd': 'VHDL', 'vhdl': 'VHDL',
+    'vue': 'Vuejs Component', 'yml': 'YAML', 'yaml': 'YAML', 'zsh': 'zsh',
+}
+
+# {file name: language}, for files whose name says what they are
+file_names = {
+    'Makefile': 'make', 'makefile': 'make', 'GNUmakefile': 'make', 'Dockerfile': 'Dockerfile',
+    'CMakeLists.txt': 'CMake', 'Rakefile': 'Ruby', 'Gemfile': 'Ruby', 'Vagrantfile': 'Ruby',
+    'Jenkinsfile': 'Groovy',
+}
+
+# {interpreter: language}, for scripts without an extension: #!/usr/bin/python3, #!/usr/bin/env bash...
+interpreters = {
+    'python': 'Python', 'sh': 'Bourne Shell', 'dash': 'Bourne Shell', 'bash': 'Bourne Again Shell', 'zsh': 'zsh',
+    'node': 'JavaScript', 'perl': 'Perl', 'ruby': 'Ruby', 'php': 'PHP', 'lua': 'Lua', 'Rscript': 'R',
+    'pwsh': 'PowerShell',
+}
+
+# Version numbers are not part of the interpreter name: python3.11 is python
+_interpreter_version = re.compile(r'[0-9.]+$')
+
+
+def _comment_expression(language: str):
+    # All the comment markers of a language in a single expression, longer ones first so that --[[ wins over --.
+    # Returns (expression, {block start: block end}), or (None, {}) for languages without comments.
+    line_markers, blocks = comment_rules[language]
+    markers = sorted(line_markers + [start for start, _ in blocks], key=len, reverse=True)
+
+    if not markers:
+        return None, {}
+
+    return re.compile('|'.join(re.escape(marker) for marker in markers).encode()), \
+        {start.encode(): re.compile(re.escape(end).encode()) for start, end in blocks}
+
+
+_expressions = {language: _comment_expression(language) for language in comment_rules}
+
+
+def detect_language(name: str, data) -> str:
+    # Language of a file from its name, or from its shebang if the name does not tell (e.g. tool.cgi starting with
+    # #!/usr/bin/perl). None for files that are not recognized.
+    base = os.path.basename(name)
+
+    if base in file_names:
+        return file_names[base]
+
+    extension = base.rpartition('.')[2].lower() if '.' in base.lstrip('.') else None
+    if extension in extensions:
+        return extensions[extension]
+
+    if data[:2] == b'#!':
+        command = bytes(data[:256]).split(b'\n')[0][2:].decode(errors='replace').split()
+
+        # #!/usr/bin/env python3: the interpreter is the first argument of env that is not an option
+        if command and os.path.basename(command[0]) == 'env':
+            command = [argument for argument in command[1:] if not argument.startswith('-') and '=' not in argument]
+
+        if command:
+            return interpreters.get(_interpreter_version.sub('', os.path.basename(command[0])))
+
+    return None
+
+
+def count_lines(language: str, data) -> tuple:
+    # Split the lines of a file into (blank, comment, code). A line is a comment if all it contains is comments,
+    # code if it contains anything else, and blank if it only contains whitespace, even inside a block comment.
+    expression, blocks = _expressions[language]
+    blank, comment, code = 0, 0, 0
+    block_end = None
+
+    for line in bytes(data).splitlines():
+        if not line.strip():
+            blank += 1
+            continue
+
+        # Languages without comments, or lines without any marker outside of a block comment
+        if block_end is None and (expression is None or expression.search(line) is None):
+            code += 1
+            continue
+
+        has_code = False
+        position = 0
+
+        while position < len(line):
+            if block_end is not None:
+                end = block_end.search(line, position)
+
+                if end is None:
+                    break
+
+                block_end = None
+                position = end.end()
+                continue
+
+            marker = expression.search(line, position)
+
+            if marker is None:
+                has_code = has_code or bool(line[position:].strip())
+                break
+
+            has_code = has_code or bool(line[position:marker.start()].strip())
+
+            if marker.group() not in blocks:
+                break
+
+            block_end = blocks[marker.group()]
+            position = marker.end()
+
+        if has_code:
+            code += 1
+        else:
+            comment += 1
+
+    return blank, comment, code
+
+
+def count_file(name: str, data) -> tuple:
+    # (language, blank, comment, code) of a text file like cloc --by-file, language is None if it is not recognized
+    language = detect_language(name, data)
+
+    if language is None:
+        return None, 0, 0, 0
+
+    return (language, *count_lines(language, data))
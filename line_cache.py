@@ -0,0 +1,99 @@
+import time
+import sqlite3
+from threading import Lock
+
+
+class LineCountCache:
+    # Persistent line counts of git blobs, keyed by blob SHA: a blob with the same SHA always has the same content,
+    # so files unchanged since the last run (or vendored in more than one repository) are only counted once.
+    # cloc results are keyed by file name too, since cloc detects the language from the name and not the content.
+    # Results of the built-in counter (see languages.py) are kept apart from cloc's, in the native table.
+    # Entries not used for `ttl` seconds are dropped when the cache is closed.
+    def __init__(self, path: str, ttl: int):
+        self.ttl = ttl
+        self.lock = Lock()
+        # More than one process can use the cache at the same time, the write-ahead log lets them read while
+        # another one is writing and the timeout makes them wait for each other's writes
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS lines ("
+                        "sha TEXT PRIMARY KEY, "
+                        "non_blank INTEGER NOT NULL, "
+                        "used_at REAL NOT NULL)")
+        for table in ['cloc', 'native']:
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} ("
+                            "sha TEXT NOT NULL, "
+                            "name TEXT NOT NULL, "
+                            "language TEXT, "
+                            "blank INTEGER NOT NULL, "
+                            "comment INTEGER NOT NULL, "
+                            "code INTEGER NOT NULL, "
+                            "used_at REAL NOT NULL, "
+                            "PRIMARY KEY (sha, name))")
+        self.db.commit()
+
+    def _select(self, query: str, keys: list, width: int) -> list:
+        # SQLite limits the number of parameters of a query, look keys up in batches
+        rows = []
+        batch = 500 // width
+
+        for i in range(0, len(keys), batch):
+            chunk = keys[i:i + batch]
+            placeholders = ', '.join(['(' + ', '.join(['?'] * width) + ')'] * len(chunk))
+            params = [value for key in chunk for value in (key if width > 1 else (key,))]
+            rows += self.db.execute(query.format(placeholders), params).fetchall()
+
+        return rows
+
+    def get_lines(self, shas: list) -> dict:
+        # Returns {sha: non-blank lines} for the cached blobs among shas
+        shas = list(set(shas))
+        now = time.time()
+
+        with self.lock:
+            rows = self._select("SELECT sha, non_blank FROM lines WHERE sha IN (VALUES {})", shas, 1)
+            self.db.executemany("UPDATE lines SET used_at = ? WHERE sha = ?", [(now, sha) for sha, _ in rows])
+            self.db.commit()
+
+        return dict(rows)
+
+    def put_lines(self, counts: dict):
+        now = time.time()
+
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO lines VALUES (?, ?, ?)",
+                                [(sha, lines, now) for sha, lines in counts.items()])
+            self.db.commit()
+
+    def get_cloc(self, keys: list, native: bool = False) -> dict:
+        # Returns {(sha, name): (language, blank, comment, code)} for the cached blobs among keys.
+        # language is None for files cloc does not recognize. native looks up results of the built-in counter.
+        keys = list(set(keys))
+        now = time.time()
+        table = 'native' if native else 'cloc'
+
+        with self.lock:
+            rows = self._select(f"SELECT sha, name, language, blank, comment, code FROM {table} "
+                                "WHERE (sha, name) IN (VALUES {})", keys, 2)
+            self.db.executemany(f"UPDATE {table} SET used_at = ? WHERE sha = ? AND name = ?",
+                                [(now, row[0], row[1]) for row in rows])
+            self.db.commit()
+
+        return {(sha, name): tuple(counts) for sha, name, *counts in rows}
+
+    def put_cloc(self, results: dict, native: bool = False):
+        now = time.time()
+        table = 'native' if native else 'cloc'
+
+        with self.lock:
+            self.db.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(sha, name, *counts, now) for (sha, name), counts in results.items()])
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.execute("DELETE FROM lines WHERE used_at < ?", (time.time() - self.ttl,))
+            self.db.execute("DELETE FROM cloc WHERE used_at < ?", (time.time() - self.ttl,))
+            self.db.execute("DELETE FROM native WHERE used_at < ?", (time.time() - self.ttl,))
+            self.db.commit()
+            self.db.close()
@@ -1,48 +1,36 @@
 #!/usr/bin/env python3
 
-import requests
 import re
 import os
 import json
-import matplotlib.pyplot as plot
-from typing import List
+import cProfile
+import shutil
+import multiprocessing
+from threading import Lock
+from contextlib import nullcontext
 from datetime import datetime, timedelta
-from subprocess import run
-
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import api
+import sloc
+import clones
+import history
+import metrics
+import graphql_api
+from line_cache import LineCountCache
+from warehouse import Warehouse
+from daemon import StatsDaemon
+from scheduler import PhaseScheduler
+from api import url_api, raise_rate_limited_exception
 from ignored_files import ignored_files
-from config import owner, is_organization, output_file, output_dir, token, \
-                   dev_mode, keep_repos
+from config import owner, is_organization, extra_owners, output_file, output_dir, \
+                   dev_mode, keep_repos, stats_deadline, sloc_from_objects, clone_cache, clone_cache_max_size, \
+                   line_count_cache_file, line_count_cache_ttl, sloc_workers, graph_workers, warehouse_file, \
+                   warehouse_keep_runs, shallow_clones, clone_blob_limit, native_cloc, \
+                   skip_unchanged_repos, use_graphql, commits_from_git, daemon_host, daemon_port, daemon_refresh_interval, \
+                   daemon_ping_interval
 
 url_clone = "https://github.com"
-url_api = "https://api.github.com"
-
-
-class Graph:
-    def __init__(self,
-                 data: dict = {},
-                 minimum: int = 0,
-                 min_count: int = 0,
-                 kind: str = 'pie',
-                 legend: str = 'Default graph legend',
-                 title: str = 'Default graph title',
-                 counter: str = 'total'):
-
-        self.minimum = minimum
-        self.min_count = min_count
-        self.kind = kind
-        self.legend = legend
-        self.title = title
-        self.counter = counter
-        
-        self.data = _normalize_data(data, minimum)
-        self.count = len(self.data)
-
-    def is_suitable(self) -> bool:
-        return self.count >= self.min_count
-
-
-def raise_rate_limited_exception():
-    raise Exception("You are getting rate-limited by GitHub's servers. Try again in a few minutes.") from None
 
 
 def raise_cloc_not_installed_exception():
@@ -50,23 +38,43 @@ def raise_cloc_not_installed_exception():
                     "Install it from https://github.com/AlDanial/cloc or use wc to count lines") from None
 
 
-def get_repos(header: dict) -> list:
-    url = f'{url_api}/{"orgs" if is_organization else "users"}/{owner}/repos?per_page=100'
+def _active_repos(listing: list) -> dict:
+    # {name: time of the last push} of the repositories in a page of the listing, archived and disabled ones excluded
+    return {repo['name']: repo['pushed_at'] for repo in listing if not repo['archived'] and not repo['disabled']}
+
+
+def get_repos(header: dict, owner_name: str = owner, organization: bool = is_organization) -> dict:
+    # Returns {name: time of the last push} sorted by name, which tells what changed since a previous run
+    url = f'{url_api}/{"orgs" if organization else "users"}/{owner_name}/repos?per_page=100'
     pages = 1
 
+    # In dev mode the listing is cached in repos.json, or in repos.<owner>.json for the other owners of a batch run
+    listing_cache = 'repos.json' if owner_name == owner else f'repos.{owner_name}.json'
+
     # As of the time of writing, we don't *need* pagination as we have < 100 repos, but just for future proofing
     # here is code that can handle n pages of repositories
     try:
-        if not (dev_mode and os.path.isfile('repos.json')):
-            print("\n\nGetting repositories information...")
-            response = requests.get(url, headers=header)
+        if use_graphql and not (dev_mode and os.path.isfile(listing_cache)):
+            # A single request per 100 repositories, their languages are fetched along with them
+            print(f"\n\nGetting repositories information of {owner_name} through GraphQL...")
+            listing = graphql_api.get_repositories(header, owner_name)
+
+            if dev_mode:
+                with open(listing_cache, 'w') as f:
+                    json.dump(listing, f)
+
+            repos = _active_repos(listing)
+
+        elif not (dev_mode and os.path.isfile(listing_cache)):
+            print(f"\n\nGetting repositories information of {owner_name}...")
+            response = api.get(url, header)
 
             # If in devmode, cache the response in case it does not yet exist
             if dev_mode:
-                with open('repos.json', 'w') as f:
+                with open(listing_cache, 'w') as f:
                     json.dump(response.json(), f)
 
-            repos = [repo['name'] for repo in response.json() if not repo['archived'] and not repo['disabled']]
+            repos = _active_repos(response.json())
 
             # If the result page is only one page long, no link header is present
             if 'link' in response.headers:
@@ -76,432 +84,517 @@ def get_repos(header: dict) -> list:
                     if rel.strip() == 'rel="last"':
                         pages = int(re.compile('&page=(?P<page>[0-9]+)').search(location).group('page'))
 
-                for page in range(2, (pages + 1)):
-                    response = requests.get(f'{url}&page={page}', headers=header)
-                    repos += [repo['name'] for repo in response.json() if not repo['archived'] and not repo['disabled']]
+                # The number of pages is known at this point, so the remaining ones can be fetched all at once
+                for response in api.get_all([f'{url}&page={page}' for page in range(2, (pages + 1))], header):
+                    repos.update(_active_repos(response.json()))
 
         else:
-            print('\n\nUsing cache for repository information')
-            with open('repos.json', 'r') as f:
-                repos = [repo['name'] for repo in json.load(f) if not repo['archived'] and not repo['disabled']]
+            print(f'\n\nUsing cache for repository information of {owner_name}')
+            with open(listing_cache, 'r') as f:
+                repos = _active_repos(json.load(f))
 
         # ignore case when sorting list of repos to prevent uppercase letters to come before lowercase letters
-        return sorted(repos, key=str.casefold)
+        return {repo: repos[repo] for repo in sorted(repos, key=str.casefold)}
 
     except TypeError:
         raise_rate_limited_exception()
 
 
-def get_anonymous_commits_stats(repos: list, header: dict) -> dict:
+def get_all_repos(header: dict, owners: dict = None) -> dict:
+    # get_repos for owner, or for every owner of a batch run ({owner: is_organization}, see --batch), one after the
+    # other. Repositories of a batch run are named owner/name, since different owners may have repositories with the
+    # same name, and are all collected together.
+    if not owners:
+        return get_repos(header)
+
+    repos = {}
+
+    for owner_name, organization in owners.items():
+        repos.update({f'{owner_name}/{repo}': pushed_at
+                      for repo, pushed_at in get_repos(header, owner_name, organization).items()})
+
+    return repos
+
+
+def _reusable(repos: list, statistic: str, warehouse) -> dict:
+    # {repo: run id} of the repositories that were not pushed to since a run that collected statistic, see Warehouse
+    reused = warehouse.reusable(repos, statistic) if warehouse else {}
+
+    with api.print_lock:
+        if reused and warehouse.resumed:
+            print(f"\t{len(reused)}/{len(repos)} repositories were collected before the run was interrupted or were "
+                  f"not pushed to since the last run, reusing their stats")
+        elif reused:
+            print(f"\t{len(reused)}/{len(repos)} repositories were not pushed to since the last run, reusing their "
+                  f"stats")
+
+    return reused
+
+
+def _is_complete(status_code: int) -> bool:
+    # Whether a statistic is there: 202 means GitHub is still computing it
+    return 200 <= status_code <= 299 and status_code != 202
+
+
+def _collect_statistic(repos: list, statistic: str, warehouse, load, add, fetch, on_result=None) -> dict:
+    # {repo: (status_code, json)} of a statistic for every repository, as returned by fetch(repos, on_result), which
+    # calls on_result as in api.fetch_all. Repositories not pushed to since a run that collected the statistic are
+    # loaded from the warehouse with load(warehouse, run_id, repo) instead, the others are stored with
+    # add(warehouse, repo, json) as soon as each one is there, so that an interrupted run can be resumed.
+    # on_result(repo, status_code, json) is called for every repository, fetched or reused.
+    def store(repo: str, status_code: int, json_response):
+        if warehouse and _is_complete(status_code):
+            add(warehouse, repo, json_response)
+            warehouse.mark_collected(repo, statistic)
+
+        if on_result:
+            on_result(repo, status_code, json_response)
+
+    reused = _reusable(repos, statistic, warehouse)
+    fetched = fetch([repo for repo in repos if repo not in reused], store)
+    responses = {repo: fetched[repo] if repo not in reused else (200, load(warehouse, reused[repo], repo))
+                 for repo in repos}
+
+    for repo in reused:
+        warehouse.mark_reused(repo, statistic, reused[repo])
+
+        if on_result:
+            on_result(repo, *responses[repo])
+
+    return responses
+
+
+def _fetch_commit_stats(repos: list, endpoint: str, header: dict, cache_suffix: str, deadline: float,
+                        on_result=None) -> dict:
+    # {repo: (status_code, json)} of a statistics endpoint of GitHub, or computed the same way from the history of
+    # each repository with commits_from_git, see history.py. on_result is called as in api.fetch_all.
+    if commits_from_git:
+        return history.fetch_all(repos, endpoint, lambda repo: f'{url_clone}/{api.full_name(repo)}',
+                                 update=not (dev_mode and keep_repos), on_result=on_result)
+
+    return api.fetch_all(repos, f'stats/{endpoint}', header, cache_suffix, deadline=deadline, on_result=on_result)
+
+
+def get_anonymous_commits_stats(repos: list, header: dict, deadline: float = stats_deadline, warehouse=None) -> dict:
     # see https://docs.github.com/en/free-pro-team@latest/rest/reference/repos#statistics
     stats = {'total': 0}
+    unix_one_year_ago = int((datetime.now() - timedelta(days=365)).timestamp())
 
-    if dev_mode:
-        try:
-            os.mkdir('repo-stats')
-        except FileExistsError:
-            pass
+    # GitHub only sends the last 52 weeks, stored weeks that are more than one year old by now are left out too
+    def load(warehouse: Warehouse, run_id: int, repo: str) -> list:
+        return [weekly for weekly in warehouse.load_repository_weeks(run_id, repo)
+                if weekly['week'] > unix_one_year_ago]
 
-    print("\n\nGetting anonymous commits stats...")
-    for i, repo in enumerate(repos):
-        if(not (os.path.isfile(os.path.join('repo-stats', f'{repo}.anonymous.json')) and dev_mode)):
-            response = requests.get(f"{url_api}/repos/{owner}/{repo}/stats/commit_activity", headers=header)
+    def fetch(repos: list, on_result) -> dict:
+        return _fetch_commit_stats(repos, 'commit_activity', header, '.anonymous', deadline, on_result)
 
-            # If in devmode, cache the response in case it does not yet exist
-            if dev_mode:
-                with open(os.path.join('repo-stats', f'{repo}.anonymous.json'), 'w') as f:
-                    json.dump(response.json(), f)
+    with api.print_lock:
+        print("\n\nGetting anonymous commits stats...")
+    responses = _collect_statistic(repos, 'commit_activity', warehouse, load, Warehouse.add_repository_weeks, fetch)
 
-            print(f"\t{i + 1}/{len(repos)} - {repo} - {'OK' if response.status_code == 200 else 'Awaiting new data...'}")
-
-            if response.status_code == 403:
-                raise_rate_limited_exception()
-            elif 200 <= response.status_code <= 299:
-                stats[repo] = sum([weekly['total'] for weekly in response.json()])
-                stats['total'] += stats[repo]
+    for repo, (status_code, json_response) in responses.items():
+        if _is_complete(status_code):
+            stats[repo] = sum([weekly['total'] for weekly in json_response])
+            stats['total'] += stats[repo]
 
-        else:
-            print(f"\t{i + 1}/{len(repos)} - {repo} - Using cached result...")
-            with open(os.path.join('repo-stats', f'{repo}.anonymous.json'), 'r') as f:
-                stats[repo] = sum([weekly['total'] for weekly in json.load(f)])
-                stats['total'] += stats[repo]
+    with api.print_lock:
+        print("\n")
 
-    print("\n")
     return stats
 
 
-def get_contributors_commits_stats(repos: list, header: dict) -> dict:
+def get_contributors_commits_stats(repos: list, header: dict, deadline: float = stats_deadline, warehouse=None,
+                                   on_repo=None) -> dict:
     # see https://docs.github.com/en/free-pro-team@latest/rest/reference/repos#get-all-contributor-commit-activity
+    # on_repo(repo, contributors=stats[repo]) is called for each repository as soon as its contributors are there.
     stats = {'total': {}, 'past_year': {}}
     unix_one_year_ago = int((datetime.now() - timedelta(days=365)).timestamp())
 
-    if dev_mode:
-        try:
-            os.mkdir('repo-stats')
-        except FileExistsError:
-            pass
+    # numpy takes a while to import, only do it when commits are actually counted
+    from activity import ActivityMatrix, COMMITS
 
-    print("Getting contributors commits stats...")
-    for i, repo in enumerate(repos):
-        if(not (os.path.isfile(os.path.join('repo-stats', f'{repo}.json')) and dev_mode)):
-            response = requests.get(f"{url_api}/repos/{owner}/{repo}/stats/contributors", headers=header)
+    def repo_stats(repo: str, activity) -> dict:
+        # Repositories GitHub did not manage to compute statistics for in time are kept, but without contributors
+        if activity is None:
+            return {'total': {}, 'past_year': {}}
 
-            # If in devmode, cache the response in case it does not yet exist
-            if dev_mode:
-                with open(os.path.join('repo-stats', f'{repo}.json'), 'w') as f:
-                    json.dump(response.json(), f)
+        return {'total': activity.total(repo),
+                'past_year': activity.by_author(activity.window(since=unix_one_year_ago, repo=repo)[COMMITS], repo)}
 
-            print(f"\t{i + 1}/{len(repos)} - {repo} - {'OK' if response.status_code == 200 else 'Awaiting new data...'}")
+    def fetch(repos: list, on_result) -> dict:
+        return _fetch_commit_stats(repos, 'contributors', header, '', deadline, on_result)
 
-            if response.status_code == 403:
-                raise_rate_limited_exception()
+    def collected(repo: str, status_code: int, json_response):
+        on_repo(repo, contributors=repo_stats(repo, ActivityMatrix({repo: json_response})
+                                              if _is_complete(status_code) else None))
 
-            elif 200 <= response.status_code <= 299:
-                json_response = response.json()
+    with api.print_lock:
+        print("Getting contributors commits stats...")
+    responses = _collect_statistic(repos, 'contributors', warehouse, Warehouse.load_contributor_weeks,
+                                   Warehouse.add_contributor_weeks, fetch, collected if on_repo else None)
 
-            else:
-                print('\n')
-                return stats
+    contributors = {repo: json_response for repo, (status_code, json_response) in responses.items()
+                    if _is_complete(status_code)}
+
+    # Weekly activity of every author to every repository, any time window is a slice of it
+    activity = ActivityMatrix(contributors)
+
+    for repo in responses:
+        stats[repo] = repo_stats(repo, activity if repo in contributors else None)
+
+    stats['total'] = activity.total()
+    stats['past_year'] = activity.by_author(activity.window(since=unix_one_year_ago)[COMMITS])
+
+    with api.print_lock:
+        print("\n")
 
-        else:
-            print(f"\t{i + 1}/{len(repos)} - {repo} - Using cached result...")
-            with open(os.path.join('repo-stats', f'{repo}.json'), 'r') as f:
-                json_response = json.load(f)
-
-        stats[repo] = {
-            'total': {author['author']['login']: author['total']
-                      for author in json_response},
-            'past_year': {author['author']['login']: sum(week['c']
-                                                         for week in author['weeks']
-                                                         if week['w'] > unix_one_year_ago)
-                          for author in json_response},
-        }
-
-        for author in json_response:
-            login = author['author']['login']
-            if login not in stats['total']:
-                stats['total'][login] = 0
-                stats['past_year'][login] = 0
-            stats['total'][login] += author['total']
-            stats['past_year'][login] += sum(week['c']
-                                             for week in author['weeks']
-                                             if week['w'] > unix_one_year_ago)
-
-    print("\n")
     return stats
 
 
-def _cleanup_repos(repos: list):
-    run("rm -rf repos".split())
+# All the ignored_files expressions combined into one, compiled once per run. (?!) never matches anything.
+_ignored_expression = re.compile('|'.join(f'(?:{expression})' for expression in ignored_files) or '(?!)')
+
+
+# The ignored_files expressions that only match top level names, like ^node_modules$ or ^\.git.*, as the
+# sparse-checkout patterns those directories are left out of shallow clones with. Anything else is still filtered by
+# _filter_ignored_files once the files are listed, leaving out too little here only makes clones bigger.
+_sparse_exclusions = [re.sub(r'\\(.)', r'\1', match.group(1)) + ('*' if match.group(2) else '')
+                      for match in (re.fullmatch(r'\^((?:\\\.|[\w-])+)(?:\$|(\.\*))', expression)
+                                    for expression in ignored_files) if match]
+
+
+def _filter_ignored_files(files: list) -> list:
+    # Apply the ignored_files rules to a list of paths, as listed by git. A file is dropped if its path or the path of
+    # any directory containing it matches an expression. Each directory is matched only once however many files it
+    # contains, and files in an ignored directory are dropped without matching their own path.
+    ignored_dirs = {}
+
+    def is_ignored_dir(directory: str) -> bool:
+        if directory not in ignored_dirs:
+            parent = directory.rpartition('/')[0]
+            ignored_dirs[directory] = (parent != '' and is_ignored_dir(parent)) or \
+                                      _ignored_expression.search(directory) is not None
 
+        return ignored_dirs[directory]
 
-def _find_ignored_files(repo: str) -> list:
-    # Store already excluded dirs to avoid unneccessarily iterating a bunch of already excluded paths
-    excluded_dirs = []
     output = []
 
-    for root, dirs, files in os.walk(os.path.join('repos', repo)):
-        # For each directory in the excluded directories list such that the root currently being evaluated is a children
-        # of said directory, append a dummy element to the list. If the list is True (non-empty), then skip the current
-        # root altogether since we already excluded its parent, no need to recurse and waste further time.
-        # Could have been done with a nested for loop, however i would have had no clean way to continue the outer loop.
-        if [1 for excluded in excluded_dirs if root.replace(os.path.join('repos', repo), '').strip('/').startswith(excluded)]:
+    for file in files:
+        directory = file.rpartition('/')[0]
+
+        if directory != '' and is_ignored_dir(directory):
             continue
 
-        dirs_list = [os.path.join(root.replace(os.path.join('repos', repo), '').strip('/'), d) for d in dirs]
-        files_list = [os.path.join(root.replace(os.path.join('repos', repo), '').strip('/'), f) for f in files]
-
-        # Some files can be counted twice or more if they match more than one regex. We could fix it by iterating over
-        # elements of the array instead of the list of expressions, but that would mean compiling the expression two
-        # times (much slower) or giving up on using the excluded_dirs feature (slower). Since having duplicate entries
-        # is not a problem, I decided to leave this as-is.
-        for expression in ignored_files:
-            reg = re.compile(expression)
-
-            for element in dirs_list:
-                if reg.search(element):
-                    excluded_dirs.append(element)
-                    output.append(element)
-                
-            for element in files_list:
-                if reg.search(element):
-                    output.append(element)
-    
+        if _ignored_expression.search(file) is None:
+            output.append(file)
+
     return output
 
 
-def get_lines_stats(repos: list, use_cloc: bool):
-    stats = {'total': {'sloc': 0, 'all': 0}} if use_cloc else {'total': 0}
+# Line count cache of the current SLOC worker process, each worker opens its own connection
+_line_cache = None
 
-    lang_by_repo = {}
-    lang_total = {}
 
-    if use_cloc:
-        lang_total['total'] = 0
+def _init_sloc_worker():
+    global _line_cache
 
-    if not (dev_mode and keep_repos):
-        _cleanup_repos(repos)
+    # Forked workers start with a copy of the metrics of the main process, which are not theirs
+    metrics.reset()
 
-    print("Getting SLOC stats...")
+    if line_count_cache_file:
+        _line_cache = LineCountCache(line_count_cache_file, line_count_cache_ttl)
 
-    try:
-        os.mkdir('repos')
-    except FileExistsError:
-        pass
 
-    for i, repo in enumerate(repos):
-        if not os.path.isdir(os.path.join('repos', repo)):
-            with open(os.devnull, "w") as sink:
-                run(f"git clone {url_clone}/{owner}/{repo} {os.path.join('repos', repo)}".split(), stdout=sink, stderr=sink)
+def _count_repo_lines(repo: str, use_cloc: bool, native: bool, from_objects: bool, keep: bool):
+    # Clone a repository and count its lines. This runs in a SLOC worker process and only touches its own clone,
+    # results are returned as (stats, languages, cloned) and merged by get_lines_stats. With native, code, comments
+    # and blanks are counted by the built-in counter instead of cloc.
+    path = clones.clone_path(repo, from_objects)
 
-        ignored_list = _find_ignored_files(repo)
+    with metrics.timer('repository_step_seconds', step='clone', repo=repo):
+        cloned = clones.prepare_clone(f'{url_clone}/{api.full_name(repo)}', path, from_objects,
+                                      update=not (dev_mode and keep_repos), shallow=shallow_clones,
+                                      blob_limit=clone_blob_limit, sparse=_sparse_exclusions)
 
-        if use_cloc:
+    try:
+        # Running git or cloc in a missing directory would end up counting whatever repository contains it.
+        # I know, ignoring files directly from the git ls-tree command is tempting.
+        # However we are now using an exhaustive list of files as a blacklist instead of simple patterns.
+        # For very large repositories, we might hit the shell argument list size limit.
+        # Therefore, we are removing blacklisted files in post-production.
+        with metrics.timer('repository_step_seconds', step='list', repo=repo):
+            tree_files = sloc.list_tree_files(path) if cloned else []
+
+        with metrics.timer('repository_step_seconds', step='filter', repo=repo):
+            kept = set(_filter_ignored_files([name for name, _ in tree_files]))
+            tree_files = [file for file in tree_files if file[0] in kept]
+
+        # Blobs too big to be cloned are fetched all at once when they are counted, see sloc.count_tree_lines
+        absent = sloc.missing_blobs(path) if cloned and from_objects and shallow_clones and clone_blob_limit else None
+
+        if not use_cloc:
+            # Blank / whitespace-only lines and binary files are not counted
+            with metrics.timer('repository_step_seconds', step='count', repo=repo):
+                return sloc.count_tree_lines(path, tree_files, from_objects, _line_cache, absent), None, cloned
+
+        if native:
+            with metrics.timer('repository_step_seconds', step='count', repo=repo):
+                results = sloc.count_tree_languages(path, tree_files, from_objects, _line_cache, absent)
+        else:
             try:
-                with open('clocignore', 'w') as clocignore:
-                    for element in ignored_list:
-                        clocignore.write(f'{element}\n')
+                with metrics.timer('repository_step_seconds', step='cloc', repo=repo):
+                    results = sloc.cloc_tree_files(path, tree_files, _line_cache)
+            except FileNotFoundError:
+                raise_cloc_not_installed_exception()
 
-                output = run(f"cloc --csv --hide-rate --quiet --exclude-list-file=../../clocignore .",
-                               shell=True,
-                               text=True,
-                               capture_output=True,
-                               cwd=os.path.join('repos', repo)).stdout.splitlines()[2:]
+        languages = {}
+        repo_stats = {'sloc': 0, 'comments': 0, 'blanks': 0}
 
-                lang_by_repo[repo] = {}
-                lang_by_repo[repo]['total'] = 0
+        for language, blank, comment, code in results:
+            # Files cloc does not recognize
+            if language is None:
+                continue
 
-                for line in output:
-                    language,blank,comment,code = line.split(',')[-4:]
+            if language not in languages:
+                languages[language] = 0
 
-                    if language == 'SUM':
-                        continue
+            languages[language] += code
 
-                    lang_by_repo[repo][language] = int(code)
-                    lang_by_repo[repo]['total'] += int(code)
+            repo_stats['sloc'] += code
+            repo_stats['comments'] += comment
+            repo_stats['blanks'] += blank
 
-                    if language not in lang_total:
-                        lang_total[language] = 0
+        # Most used languages first, as cloc lists them
+        return repo_stats, dict(sorted(languages.items(), key=lambda item: item[1], reverse=True)), cloned
 
-                    lang_total[language] += int(code)
-                    lang_total['total'] += int(code)
+    finally:
+        if not keep:
+            shutil.rmtree(path, ignore_errors=True)
 
-                if len(output) > 0:
-                    total_sloc = output[-1]
 
-                    stats[repo] = {
-                        'sloc': int(total_sloc.split(",")[-1]) or 0,
-                        'comments': int(total_sloc.split(",")[-2]) or 0,
-                        'blanks': int(total_sloc.split(",")[-3]) or 0,
-                    }
-                else:  # there are no lines in this repository
-                    stats[repo] = {
-                        'sloc': 0,
-                        'comments': 0,
-                        'blanks': 0,
-                    }
+def _sloc_task(repo: str, use_cloc: bool, native: bool, from_objects: bool, keep: bool):
+    # Entry point of the SLOC workers: the metrics gathered while counting travel back along with the results
+    return (*_count_repo_lines(repo, use_cloc, native, from_objects, keep), metrics.take())
 
-                stats['total']['sloc'] += stats[repo]['sloc']
-                stats['total']['all'] += stats[repo]['sloc'] + stats[repo]['comments'] + stats[repo]['blanks']
 
-            except IndexError:
-                raise_cloc_not_installed_exception()
+def _keep_clones() -> bool:
+    # Clones are kept between runs either as a cache, updated with git fetch, or as they are when developing
+    return clone_cache or (dev_mode and keep_repos)
 
-        else:
-            git_files = run(f"cd {os.path.join('repos', repo)} && git ls-files -- . && cd ..",
-                            shell=True, text=True, capture_output=True).stdout.splitlines()
-
-            # I know, ignoring files directly from the git ls-files command is tempting.
-            # However we are now using an exhaustive list of files as a blacklist instead of simple patterns.
-            # For very large repositories, we might hit the shell argument list size limit.
-            # Therefore, we are removing blacklisted files in post-production.
-            for file in ignored_list:
-                try:
-                    git_files.remove(file)
-                except ValueError:
-                    pass
-
-            # remove blank / whitespace-only lines
-            for file in git_files:
-                run(f"sed '/^\s*$/d' '{os.path.join('repos', repo, file)}' &> /dev/null", shell=True)
-
-            stats[repo] = 0
-
-            for file in git_files:
-                stats[repo] += int(run(f"cd {os.path.join('repos', repo)} && wc -l {file.encode('utf-8').decode('unicode-escape').encode('latin1').decode('utf-8')} && cd ..",
-                                  shell=True,
-                                  text=True,
-                                  capture_output=True).stdout.splitlines()[-1].split(" ")[-2])
 
-            stats['total'] += stats[repo]
+def prepare_clones():
+    # Start from scratch if clones are not kept, before anything is cloned
+    if not _keep_clones():
+        clones.remove_clones()
+
+    _make_directory(clones.clones_dir)
+
+
+def clean_clones():
+    # Trim the clone cache, or delete the clones if they are not kept, once nothing is cloning anymore
+    if clone_cache and not (dev_mode and keep_repos):
+        clones.evict_clones(clone_cache_max_size)
+    elif not _keep_clones():
+        clones.remove_clones()
 
-        print(f"\t{i + 1}/{len(repos)} -- {stats[repo]['sloc'] if use_cloc else stats[repo]} "
-              f"total non-blank lines in repo {repo}")
 
-        if not (dev_mode and keep_repos):
-            run(f"rm -rf {os.path.join('repos', repo)}".split())
+def start_sloc_workers(context=None) -> ProcessPoolExecutor:
+    # The pool of processes get_lines_stats clones and counts with. Processes are forked as soon as the first task is
+    # submitted: start them right away, before the collectors (see collect_all_stats) start threads that could be
+    # holding a lock the workers would inherit as held forever. Where other threads are running anyway (the HTTP
+    # server of the daemon), context is a multiprocessing context that does not fork the current process.
+    pool = ProcessPoolExecutor(max_workers=sloc_workers, mp_context=context, initializer=_init_sloc_worker)
+    pool.submit(int)
+    return pool
 
-    if not (dev_mode and keep_repos):
-        run("rm -rf repos".split())
+
+def get_lines_stats(repos: list, use_cloc: bool, warehouse=None, pool: ProcessPoolExecutor = None, on_repo=None):
+    # Clones go in clones.clones_dir, see prepare_clones and clean_clones. pool is a pool started by
+    # start_sloc_workers, a new one is started (and shut down) otherwise.
+    # on_repo(repo, lines=stats[repo], languages=languages of repo) is called for each repository as soon as it is
+    # counted, languages are None without cloc.
+    stats = {'total': {'sloc': 0, 'all': 0}} if use_cloc else {'total': 0}
+
+    lang_by_repo = {}
+    lang_total = {}
 
     if use_cloc:
-        run("rm -f clocignore".split())
+        lang_total['total'] = 0
 
-    return stats, lang_by_repo, lang_total
+    keep = _keep_clones()
 
+    with api.print_lock:
+        print("Getting SLOC stats...")
 
-def __generate_chart(data: dict, minimum: int, graph_type: str, legend: str, counter: str, title: str, axis):
-    keys = data.keys()
-    values = data.values()
-    count = len(values)
+    _make_directory(clones.clones_dir)
 
-    total = 0
-    labels = []
+    # The built-in counter replaces cloc when asked to, or when cloc is not installed
+    native = use_cloc and (native_cloc or shutil.which('cloc') is None)
+    if native and not native_cloc:
+        with api.print_lock:
+            print("\tcloc is not installed, counting lines with the built-in counter instead (see native_cloc)")
 
-    for key in data:
-        total += data[key]
-    
-    for key in data:
-        percentage = (float(data[key] * 100) / float(total))
-        labels.append(f'{key} ({percentage:.2f}%)')
+    # cloc needs actual files, but other counters can read blobs from a bare clone, without a working tree
+    from_objects = sloc_from_objects and (not use_cloc or native)
 
-    if counter == 'classes':
-        total_count = len(data)
-    else:
-        total_count = total
+    # Repositories are cloned and counted by a pool of processes, so that some of them are cloning while the others
+    # are counting, and counting runs on more than one core
+    results = {}
+    statistic = 'native' if native else 'cloc' if use_cloc else 'wc'
+
+    def store(repo: str):
+        # Each repository is stored as soon as it is counted, so that an interrupted run can be resumed
+        repo_stats, languages, cloned = results[repo]
+
+        if cloned and warehouse:
+            if use_cloc:
+                warehouse.add_lines(repo, repo_stats['sloc'], repo_stats['comments'], repo_stats['blanks'])
+                warehouse.add_languages(repo, languages)
+            else:
+                warehouse.add_lines(repo, repo_stats)
+
+            warehouse.mark_collected(repo, statistic)
+
+        counted(repo)
 
-    if graph_type == 'pie':
-        # Set the color map and generate a properly sized color cycle
-        colors = []
-        colormaps = {'Pastel1':9, 'Accent':8, 'Set1':9, 'tab20':20, 'tab20b':20}
+    def counted(repo: str):
+        if on_repo:
+            repo_stats, languages, _ = results[repo]
+            on_repo(repo, lines=repo_stats, languages={'total': repo_stats['sloc'], **languages} if use_cloc else None)
 
-        for cm in colormaps:
-            cmap = plot.get_cmap(cm)
-            colors += [cmap(i/colormaps[cm]) for i in range(colormaps[cm])]
+    # Repositories that were not pushed to are not even cloned, their counts cannot have changed
+    for repo, run_id in _reusable(repos, statistic, warehouse).items():
+        lines = warehouse.load_lines(run_id, repo)
 
-        step = int(len(colors)/count)
-        axis.set_prop_cycle('color', [colors[i*step] for i in range(count)])
+        # Counts the warehouse lost track of (e.g. deleted with their run by an older version) are counted again
+        if lines is None:
+            continue
 
-        wedges, texts = axis.pie(values, counterclock=False, startangle=90)
-        legend = axis.legend(wedges, labels, title=legend, bbox_to_anchor=(1.01, 1), loc='upper left')
-        axis.set_aspect('equal')
-        axis.set_title(f'{title} (total: {total_count})')
+        sloc_count, comments, blanks = lines
 
-    elif graph_type == 'bar':
-        y = [i for i in range(count)]
+        if use_cloc:
+            results[repo] = {'sloc': sloc_count, 'comments': comments, 'blanks': blanks}, \
+                            warehouse.load_languages(run_id, repo), True
+        else:
+            results[repo] = sloc_count, None, True
 
-        bars = axis.barh(y, values, align='center')
-        axis.set_yticks(y)
-        axis.set_yticklabels(keys)
-        axis.invert_yaxis()
-        axis.set_xlabel(legend)
-        axis.set_title(f'{title} (total: {total_count})')
+        # Only the counts are stored again, the languages stay in the rows of run_id
+        warehouse.add_lines(repo, sloc_count, comments, blanks)
+        warehouse.mark_reused(repo, statistic, run_id)
+        counted(repo)
 
-        for bar in bars:
-            width = bar.get_width()
-            axis.annotate(str(width), xy=(width, bar.get_y() + bar.get_height() / 2), xytext=(3,0), textcoords='offset points', ha='left', va='center')
+    with start_sloc_workers() if pool is None else nullcontext(pool) as pool:
+        futures = {pool.submit(_sloc_task, repo, use_cloc, native, from_objects, keep): repo
+                   for repo in repos if repo not in results}
 
+        error = None
 
-def _normalize_data(data: dict, min_value: float):
-    result = dict(data)
+        for i, future in enumerate(as_completed(futures)):
+            repo = futures[future]
 
-    # Remove summatory keys from the dictionary.
-    # The additional 'nope' is there just to avoid having to put everything in a try in case the "total" key does not exist. 
-    result.pop('total', 'nope')
-    result.pop('past_year', 'nope')
+            # The other repositories are still counted and stored before giving up, so that resuming the run only
+            # counts this one again
+            try:
+                *results[repo], worker_metrics = future.result()
+            except Exception as e:
+                error = error or e
 
-    other = 0
+                with api.print_lock:
+                    print(f"\t{i + 1}/{len(futures)} -- Could not count lines in repo {repo}: {e}")
 
-    for key in list(result.keys()):
-        if result[key] < min_value:
-            other += result.pop(key)
+                continue
 
-    # Order data dictionary by size of elements
-    result = {k:v for k,v in sorted(result.items(), key=lambda x: int(x[1]), reverse=True)}
+            repo_stats, _, cloned = results[repo]
+            metrics.merge(worker_metrics)
+            store(repo)
 
-    if other > 0:
-        result['other'] = other
-    
-    return result
+            with api.print_lock:
+                if not cloned:
+                    print(f"\tCould not clone {repo}, its lines will not be counted")
 
+                print(f"\t{i + 1}/{len(futures)} -- {repo_stats['sloc'] if use_cloc else repo_stats} "
+                      f"total non-blank lines in repo {repo}")
 
-def generate_figure(graphs: List[Graph], path: str):
-    filtered = sorted([graph for graph in graphs if graph.is_suitable()], key=lambda x: 0 if x.kind == 'pie' else 1)
-    heights = []
+        if error is not None:
+            raise error
 
-    # If we have no suitable graphs, return without doing nothing
-    if len(filtered) == 0:
-        return
+    # Merge in the same order as repos, independently of which repository was done first
+    for repo in repos:
+        stats[repo], languages, _ = results[repo]
+
+        if use_cloc:
+            lang_by_repo[repo] = {'total': stats[repo]['sloc'], **languages}
+
+            for language in lang_by_repo[repo]:
+                if language not in lang_total:
+                    lang_total[language] = 0
+
+                lang_total[language] += lang_by_repo[repo][language]
+
+            stats['total']['sloc'] += stats[repo]['sloc']
+            stats['total']['all'] += stats[repo]['sloc'] + stats[repo]['comments'] + stats[repo]['blanks']
 
-    for graph in filtered:
-        if graph.kind == 'pie':
-            heights.append(7)
         else:
-            heights.append((0.3 * graph.count))
+            stats['total'] += stats[repo]
+
+    # Drop line counts of files that have not been seen for a long time
+    if line_count_cache_file:
+        LineCountCache(line_count_cache_file, line_count_cache_ttl).close()
 
-    figure, axis = plot.subplots(len(filtered),
-                                 figsize=(12, sum(heights) + 1),
-                                 dpi=600,
-                                 gridspec_kw={'height_ratios': [h / heights[0] for h in heights]})
+    return stats, lang_by_repo, lang_total
 
-    # We need a list for the following for loop and if len(filtered) = 1 axis is just an object. Maybe there is a better way to do this?
-    if len(filtered) == 1:
-        axis = [axis]
 
-    for i,graph in enumerate(filtered):
-        __generate_chart(graph.data, graph.minimum, graph.kind, graph.legend, graph.counter, graph.title, axis[i])
-    
-    plot.tight_layout()
-    plot.savefig(path, bbox_inches='tight')
-    plot.close(figure)
+def _repo_languages(json_data) -> dict:
+    # {language: bytes, 'total': bytes of all of them} of a /languages response
+    languages = {language: int(json_data[language]) for language in json_data}
+    languages['total'] = sum(languages.values())
+    return languages
 
 
-def get_language_stats(repos: list, header: dict):
+def get_language_stats(repos: list, header: dict, warehouse=None, on_repo=None):
+    # on_repo(repo, languages=langs_by_repo[repo]) is called for each repository as soon as its languages are there
     langs_by_repo = {}
     langs_total = {}
 
     langs_total['total'] = 0
 
-    print("\n\nGetting language usage information...")
+    def fetch(repos: list, on_result) -> dict:
+        if not use_graphql:
+            return api.fetch_all(repos, 'languages', header, '.languages', 'Error!', on_result=on_result)
 
-    for i, repo in enumerate(repos):
-        if not (dev_mode and os.path.isfile(os.path.join('repo-stats', f'{repo}.languages.json'))):
-            try:
-                response = requests.get(f'{url_api}/repos/{owner}/{repo}/languages', headers=header)
-                json_data = response.json()
-            except TypeError:
-                raise_rate_limited_exception()
+        # Already there in the repository listings, no further request is needed
+        languages = {}
+        responses = {}
 
-            # If in devmode, cache the response in case it does not yet exist
-            if dev_mode:
-                with open(os.path.join('repo-stats', f'{repo}.languages.json'), 'w') as f:
-                    json.dump(json_data, f)
+        for repo in repos:
+            owner_name, name = api.full_name(repo).split('/')
 
-            print(f"\t{i + 1}/{len(repos)} - {repo} - {'OK' if response.status_code == 200 else 'Error!'}")
+            if owner_name not in languages:
+                languages[owner_name] = graphql_api.get_languages(header, owner_name)
 
-        else:
-            print(f"\t{i + 1}/{len(repos)} - {repo} - Using cached result...")
-            with open(os.path.join('repo-stats', f'{repo}.languages.json'), 'r') as f:
-                json_data = json.load(f)
-        
-        langs_by_repo[repo] = {}
-        languages_sum = 0
+            responses[repo] = (200, languages[owner_name].get(name, {}))
+            on_result(repo, *responses[repo])
+
+        return responses
+
+    def collected(repo: str, status_code: int, json_data):
+        on_repo(repo, languages=_repo_languages(json_data))
+
+    with api.print_lock:
+        print("\n\nGetting language usage information...")
+    responses = _collect_statistic(repos, 'languages', warehouse, Warehouse.load_languages, Warehouse.add_languages,
+                                   fetch, collected if on_repo else None)
+
+    for repo, (status_code, json_data) in responses.items():
+        langs_by_repo[repo] = _repo_languages(json_data)
 
         for language in json_data:
             if language not in langs_total:
                 langs_total[language] = 0
 
-            if language not in langs_by_repo:
-                langs_by_repo[repo][language] = 0
-
-            langs_by_repo[repo][language] = int(json_data[language])
-            languages_sum += int(json_data[language])
-
             langs_total[language] += int(json_data[language])
             langs_total['total'] += int(json_data[language])
-        
-        langs_by_repo[repo]['total'] = languages_sum
-    
+
     return langs_total, langs_by_repo
 
 
@@ -512,22 +605,27 @@ def _make_directory(path: str):
         pass
 
 
-def print_all_stats(repos: list, commits_stats: dict, lines_stats: dict, contributors_stats: dict, language_total: dict, language_repo: dict, use_cloc: bool, generate_graphs: bool):
+def print_all_stats(repos: list, commits_stats: dict, lines_stats: dict, contributors_stats: dict, language_total: dict, language_repo: dict, use_cloc: bool, generate_graphs: bool, owner_name: str = owner, directory: str = output_dir, graph_pool: ProcessPoolExecutor = None):
+    # owner_name is the one the report is about, the owners of a batch run joined by + for the combined report of all
+    # of them. Repositories named owner/name already say which owner they belong to. graph_pool is the pool graphs are
+    # rendered with, see start_graph_workers.
+    def full_name(repo: str) -> str:
+        return repo if '/' in repo else f'{owner_name}/{repo}'
+
     _make_directory(output_dir)
+    _make_directory(directory)
 
     if generate_graphs:
+        # matplotlib takes a while to import, only do it when graphs are actually needed
+        from graphs import Graph, generate_figures, repo_graphs
+
         timestamp = datetime.now().strftime("%Y-%m-%d %H.%M.%S.%f")
-        graph_dir = os.path.join(output_dir, timestamp)
+        graph_dir = os.path.join(directory, timestamp)
         _make_directory(graph_dir)
-        _make_directory(os.path.join(graph_dir, owner))
+        _make_directory(os.path.join(graph_dir, owner_name))
 
         global_graphs = {}
 
-        yearly_repo_commits = {}
-        repo_commits = {}
-        sloc_by_repo = {}
-        lang_by_repo = {}
-
         if commits_stats is not None:
             yearly_commits_by_repo = Graph(commits_stats, 10, 1, 'pie', 'Repositories', 'Commits in the last year by repository')
             global_graphs['yearly_commits_by_repo.svg'] = yearly_commits_by_repo
@@ -538,18 +636,8 @@ def print_all_stats(repos: list, commits_stats: dict, lines_stats: dict, contrib
             global_graphs['yearly_commits_by_contributor.svg'] = yearly_commits_by_contributor
             global_graphs['commits_by_contributor.svg'] = commits_by_contributor
 
-            for repo in contributors_stats:
-                if repo not in ['total', 'past_year']:
-                    yearly_repo_commits[repo] = Graph(contributors_stats[repo]['total'], 1, 2, 'bar', 'Commits', f'Commits to {owner}/{repo} by contributor')
-                    repo_commits[repo] = Graph(contributors_stats[repo]['past_year'], 1, 2, 'bar', 'Commits', f'Commits to {owner}/{repo} in the last year by contributor')
-
         if language_total is not None:
-            total = language_total['total']
-            global_graphs['languages.svg'] = Graph(language_total, 0, 1, 'pie', 'Language', f'Language usage for all repositories in {owner}', 'classes')
-
-            for repo in language_repo:
-                total = language_repo[repo]['total']
-                lang_by_repo[repo] = Graph(language_repo[repo], 0, 1, 'pie', 'Language', f'Language usage for repository {owner}/{repo}', 'classes')
+            global_graphs['languages.svg'] = Graph(language_total, 0, 1, 'pie', 'Language', f'Language usage for all repositories in {owner_name}', 'classes')
 
         if lines_stats is not None:
             if use_cloc:
@@ -557,29 +645,33 @@ def print_all_stats(repos: list, commits_stats: dict, lines_stats: dict, contrib
                 total_sloc = Graph({r:lines_stats[r]['sloc'] for r in lines_stats if r != 'total'}, minimum, 1, 'pie', 'Repository', 'SLOC count by repository')
                 global_graphs['sloc.svg'] = (total_sloc)
 
-                for repo in lines_stats:
-                    if repo != 'total':
-                        sloc_by_repo[repo] = Graph(lines_stats[repo], 1, 1, 'pie', 'Type', f'Line distribution for repository {owner}/{repo}')
-
             else:
                 minimum = lines_stats['total'] * 0.005
                 total_sloc = Graph(lines_stats, minimum, 1, 'pie', 'Repository', 'SLOC count by repository')
                 global_graphs['sloc.svg'] = total_sloc
 
-        print("\n\nGenerating repo-specific graphs...")
-        for i, graph in enumerate(repos):
-            graphlist = [g[graph] for g in [repo_commits, yearly_repo_commits, sloc_by_repo, lang_by_repo] if len(g) > 0]
-            generate_figure(graphlist, os.path.join(graph_dir, f'{graph}.svg'))
+        repo_figures = {}
+        for graph in repos:
+            graphlist = repo_graphs(full_name(graph),
+                                    contributors_stats[graph] if contributors_stats is not None else None,
+                                    lines_stats[graph] if lines_stats is not None else None,
+                                    language_repo[graph] if language_total is not None else None, use_cloc)
+            repo_figures[os.path.join(graph_dir, f'{graph}.svg')] = (graphlist, f'{graph}.svg')
+
+            # Graphs of repositories named owner/name go in a directory for each owner
+            if '/' in graph:
+                _make_directory(os.path.join(graph_dir, graph.split('/')[0]))
 
-            print(f"\t{i + 1}/{len(repos)} - {graph}.svg")
+        general_figures = {os.path.join(graph_dir, owner_name, graph): ([global_graphs[graph]],
+                                                                        os.path.join(owner_name, graph))
+                           for graph in global_graphs}
 
-        print("\nGenerating general graphs...")
-        for i, graph in enumerate(global_graphs):
-            generate_figure([global_graphs[graph]], os.path.join(graph_dir, owner, graph))
-            print(f"\t{i + 1}/{len(global_graphs)} - {os.path.join(owner, graph)}")
+        combined_figure = {os.path.join(graph_dir, owner_name, 'combined.svg'): (list(global_graphs.values()),
+                                                                                 os.path.join(owner_name, 'combined.svg'))}
 
-        print("\nGenerating combined graph...")
-        generate_figure(global_graphs.values(), os.path.join(graph_dir, owner, 'combined.svg'))
+        generate_figures([("\n\nGenerating repo-specific graphs...", repo_figures),
+                          ("\nGenerating general graphs...", general_figures),
+                          ("\nGenerating combined graph...", combined_figure)], graph_pool)
 
     if commits_stats is not None:
         commits_output = "\n".join([f"{repo}: {commits_stats[repo]} commits past year"
@@ -655,7 +747,7 @@ def print_all_stats(repos: list, commits_stats: dict, lines_stats: dict, contrib
             languages = {language:((100 * language_repo[repo][language])/language_repo[repo]['total']) for language in language_repo[repo]}
             language_output += f'\t{repo}: {", ".join([f"{k} ({languages[k]:.2f}%)" for k in languages if k != "total"])}\n'
 
-        language_output += f'\nTotal language usage across all {owner} repositories:\n'
+        language_output += f'\nTotal language usage across all {owner_name} repositories:\n'
         language_output += '\n'.join(sorted([f"\t{language} ({(100 * language_total[language])/language_total['total']:.2f}%)" for language in language_total if language != 'total'], key=lambda x: language_total[" ".join(x.split()[:-1])], reverse=True))
     else:
         language_output = "No language stats, as you've selected at the beginning."
@@ -663,13 +755,253 @@ def print_all_stats(repos: list, commits_stats: dict, lines_stats: dict, contrib
     output = "\n\n".join([contributors_output, '*' * 42, commits_output, '*' * 42, lines_output, '*' * 42, language_output])
     print(f"\n\n{output}")
 
-    output_path = os.path.join(output_dir, f'{output_file} {datetime.now()}.txt') if not generate_graphs \
-        else os.path.join(graph_dir, owner, f'{output_file}.txt')
+    output_path = os.path.join(directory, f'{output_file} {datetime.now()}.txt') if not generate_graphs \
+        else os.path.join(graph_dir, owner_name, f'{output_file}.txt')
     with open(output_path, 'w') as out:
         out.write(f"Stats generated via https://github.com/weee-open/sardina\n"
                   f"use_cloc={use_cloc}\n"
                   f"\n{output}")
 
+    # Where the report and the graphs ended up
+    return output_path, graph_dir if generate_graphs else None
+
+
+def _sum_by_key(dicts: list) -> dict:
+    total = {}
+
+    for counts in dicts:
+        for key, value in counts.items():
+            total[key] = total.get(key, 0) + value
+
+    return total
+
+
+def owner_stats(stats: dict, owner_name: str) -> dict:
+    # The stats of a batch run (see collect_all_stats) restricted to the repositories of one owner, named without
+    # the owner and with their totals computed again, as a run for that owner alone would have returned them
+    prefix = f'{owner_name}/'
+
+    def own(by_repo: dict) -> dict:
+        return {repo[len(prefix):]: value for repo, value in by_repo.items() if repo.startswith(prefix)}
+
+    commits_stats, lines_stats, contributors_stats, language_total, language_repo = None, None, None, None, None
+
+    if stats['commits_stats'] is not None:
+        commits_stats = own(stats['commits_stats'])
+        commits_stats = {'total': sum(commits_stats.values()), **commits_stats}
+
+    if stats['contributors_stats'] is not None:
+        contributors_stats = own(stats['contributors_stats'])
+        contributors_stats = {'total': _sum_by_key([repo['total'] for repo in contributors_stats.values()]),
+                              'past_year': _sum_by_key([repo['past_year'] for repo in contributors_stats.values()]),
+                              **contributors_stats}
+
+    if stats['lines_stats'] is not None:
+        lines_stats = own(stats['lines_stats'])
+
+        if stats['use_cloc']:
+            lines_stats = {'total': {'sloc': sum(repo['sloc'] for repo in lines_stats.values()),
+                                     'all': sum(repo['sloc'] + repo['comments'] + repo['blanks']
+                                                for repo in lines_stats.values())},
+                           **lines_stats}
+        else:
+            lines_stats = {'total': sum(lines_stats.values()), **lines_stats}
+
+    if stats['language_repo'] is not None:
+        language_repo = own(stats['language_repo'])
+        language_total = _sum_by_key([{'total': 0}] + list(language_repo.values()))
+
+    return {'repos': [repo[len(prefix):] for repo in stats['repos'] if repo.startswith(prefix)],
+            'commits_stats': commits_stats, 'lines_stats': lines_stats, 'contributors_stats': contributors_stats,
+            'language_total': language_total, 'language_repo': language_repo, 'use_cloc': stats['use_cloc']}
+
+
+def start_graph_workers(context=None) -> ProcessPoolExecutor:
+    # The pool of processes graphs are rendered with, started right away like the one of start_sloc_workers
+    pool = ProcessPoolExecutor(max_workers=graph_workers, mp_context=context)
+    pool.submit(int)
+    return pool
+
+
+def _render_repo_figures(parts: list, use_cloc: bool, pool: ProcessPoolExecutor):
+    # Returns the on_repo hook of the collectors: once all of parts ('contributors', 'lines' and 'languages') of a
+    # repository are there, its figure is rendered with pool while the other repositories are still being collected,
+    # see graphs.render_ahead. print_all_stats then only has to link it.
+    collected = {}
+    lock = Lock()
+
+    def add(repo: str, **stats):
+        with lock:
+            collected.setdefault(repo, {}).update(stats)
+
+            if len(collected[repo]) < len(parts):
+                return
+
+        # matplotlib takes a while to import, only do it when graphs are actually needed
+        from graphs import repo_graphs, render_ahead
+
+        render_ahead(repo_graphs(repo if '/' in repo else f'{owner}/{repo}', collected[repo].get('contributors'),
+                                 collected[repo].get('lines'), collected[repo].get('languages'), use_cloc), pool)
+
+    return add
+
+
+def _print_run(stats: dict, generate_graphs: bool, owners: dict = None, graph_pool: ProcessPoolExecutor = None) -> dict:
+    # print_all_stats for a run. For a batch run, each owner gets its own report (and graphs) in a directory named
+    # after it, then all of them get a combined one in output_dir. Returns stats plus where the report ('report') and
+    # graphs ('graphs') of the combined one are.
+    if owners:
+        for owner_name in owners:
+            print(f"\n\nStats of {owner_name}:")
+            print_all_stats(**owner_stats(stats, owner_name), generate_graphs=generate_graphs, owner_name=owner_name,
+                            directory=os.path.join(output_dir, owner_name), graph_pool=graph_pool)
+
+        print("\n\nStats of all owners:")
+
+    report, graph_dir = print_all_stats(**stats, generate_graphs=generate_graphs,
+                                        owner_name='+'.join(owners) if owners else owner, graph_pool=graph_pool)
+
+    if generate_graphs:
+        from graphs import prune_figures
+        prune_figures()
+
+    return {**stats, 'report': report, 'graphs': graph_dir}
+
+
+def collect_all_stats(header: dict, use_cloc: bool, get_commits: bool, get_lines: bool, get_languages: bool,
+                      generate_graphs: bool, excluded_repos: list = None, full: bool = False,
+                      owners: dict = None, resume: bool = False, worker_context=None) -> dict:
+    # Collect every requested statistic, store the run in the warehouse and write the report, the graphs and the
+    # metrics. Returns what print_all_stats was given, plus where the report ('report') and graphs ('graphs') are.
+    # owners ({owner: is_organization}, see --batch) collects the repositories of all of them in a single run, which
+    # shares the HTTP session, the rate limit budget, the caches and the clone workers.
+    # resume continues the last run if it was interrupted, see Warehouse.resume_run.
+    # worker_context is the multiprocessing context worker processes are started with, see start_sloc_workers.
+
+    # Every run is stored in the warehouse, so that reports can be made again and compared with later runs.
+    # Statistics of repositories that were not pushed to since a previous run are taken from there.
+    # Batch runs are stored as a run of all their owners joined by +.
+    store = Warehouse(warehouse_file) if warehouse_file else None
+
+    def list_repos() -> list:
+        pushed_at = get_all_repos(header, owners)
+
+        repos = list(pushed_at)
+        if excluded_repos:
+            # Repositories of a batch run can be excluded by name or as owner/name
+            repos = [repo for repo in repos
+                     if repo.lower() not in excluded_repos and repo.rpartition('/')[2].lower() not in excluded_repos]
+
+        if store:
+            name = '+'.join(owners) if owners else owner
+            reuse = skip_unchanged_repos and not full
+
+            if resume and store.resume_run(name, use_cloc, pushed_at, reuse):
+                print(f"Resuming the interrupted run of {name}...")
+            else:
+                if resume:
+                    print(f"The last run of {name} was not interrupted, starting a new one")
+
+                store.start_run(name, use_cloc, pushed_at, reuse)
+
+        return repos
+
+    # Each statistic is collected as soon as the repositories are listed, all of them at the same time: commits and
+    # languages are requested from GitHub while repositories are being cloned and counted. Clones are prepared before
+    # anything is cloned and cleaned up once nothing is cloning anymore, commits_from_git clones histories too.
+    phases = PhaseScheduler()
+    phases.add('get_repos', list_repos)
+    cloning = []
+
+    if get_lines or (get_commits and commits_from_git):
+        phases.add('prepare_clones', prepare_clones)
+
+    if get_commits:
+        dependencies = ['get_repos', 'prepare_clones'] if commits_from_git else ['get_repos']
+        phases.add('get_anonymous_commits_stats',
+                   lambda repos, *_: get_anonymous_commits_stats(repos, header, warehouse=store), dependencies)
+        phases.add('get_contributors_commits_stats',
+                   lambda repos, *_: get_contributors_commits_stats(repos, header, warehouse=store, on_repo=figures),
+                   dependencies)
+
+        if commits_from_git:
+            cloning += ['get_anonymous_commits_stats', 'get_contributors_commits_stats']
+
+    if get_lines:
+        phases.add('get_lines_stats', lambda repos, _: get_lines_stats(repos, use_cloc, store, sloc_pool,
+                                                                       figures if use_cloc else None),
+                   ['get_repos', 'prepare_clones'])
+        cloning.append('get_lines_stats')
+
+    if get_languages and not use_cloc:
+        phases.add('get_language_stats', lambda repos: get_language_stats(repos, header, store, figures),
+                   ['get_repos'])
+
+    if cloning:
+        phases.add('clean_clones', lambda *_: clean_clones(), cloning)
+
+    # With graphs, the figure of each repository is rendered as soon as all of its stats are there
+    parts = (['contributors'] if get_commits else []) + (['lines', 'languages'] if get_lines and use_cloc else []) + \
+            (['languages'] if get_languages and not use_cloc else [])
+    figures = None
+
+    # The warehouse is closed even if the run fails, or the daemon would keep a connection open for every failed refresh
+    try:
+        with start_graph_workers(worker_context) if generate_graphs else nullcontext() as graph_pool:
+            with start_sloc_workers(worker_context) if get_lines else nullcontext() as sloc_pool:
+                if graph_pool and parts:
+                    figures = _render_repo_figures(parts, use_cloc, graph_pool)
+
+                collected = phases.run()
+
+            repos = collected['get_repos']
+            commits_stats = collected.get('get_anonymous_commits_stats')
+            contributors_stats = collected.get('get_contributors_commits_stats')
+            lines_stats, cloc_language_repo, cloc_language_total = collected.get('get_lines_stats', (None, None, None))
+            language_total, language_repo = collected.get('get_language_stats', (None, None))
+
+            if store:
+                store.finish_run(repos, commits_stats, lines_stats, contributors_stats,
+                                 cloc_language_repo or language_repo, use_cloc)
+
+                if warehouse_keep_runs and store.delete_old_runs(warehouse_keep_runs):
+                    print(f"Deleted the runs of {store.owner} older than the last {warehouse_keep_runs} from the "
+                          f"warehouse")
+
+            with metrics.timer('phase_seconds', phase='print_all_stats'):
+                results = _print_run({'repos': repos, 'commits_stats': commits_stats, 'lines_stats': lines_stats,
+                                      'contributors_stats': contributors_stats,
+                                      'language_total': cloc_language_total or language_total,
+                                      'language_repo': cloc_language_repo or language_repo, 'use_cloc': use_cloc},
+                                     generate_graphs, owners, graph_pool)
+    finally:
+        if store:
+            store.close()
+
+    # Timings, counters and peak memory of this run, see metrics.py
+    metrics.write_reports(output_dir)
+
+    return results
+
+
+def replay_last_run(generate_graphs: bool, owners: dict = None):
+    # Write the report (and graphs) of the last run stored in the warehouse again, without GitHub or clones, for owner
+    # or for the owners of a batch run. Returns the same as collect_all_stats, or None if there is no such run.
+    if not warehouse_file or not os.path.isfile(warehouse_file):
+        return None
+
+    store = Warehouse(warehouse_file)
+    run = store.latest_run('+'.join(owners) if owners else owner)
+    loaded = store.load_run(run[0]) if run else None
+    store.close()
+
+    if loaded is None:
+        return None
+
+    print(f"Replaying run of {run[1]}")
+    return _print_run(dict(zip(['repos', 'commits_stats', 'lines_stats', 'contributors_stats', 'language_total',
+                                'language_repo', 'use_cloc'], loaded)), generate_graphs, owners)
+
 
 def main():
     import argparse
@@ -699,68 +1031,181 @@ def main():
     parser.add_argument('-p', '--ping', required=False, default=None, action='store_true',
                         help='Re-trigger stats generation on GitHub servers. Useful with cron.')
 
+    parser.add_argument('-r', '--replay', required=False, default=None, action='store_true',
+                        help='Generate the report again from the last run stored in the warehouse, without GitHub.')
+
+    parser.add_argument('--history', required=False, default=None, action='store_true',
+                        help='Show activity by year and SLOC over time from the runs stored in the warehouse.')
+
+    parser.add_argument('-f', '--full', required=False, default=None, action='store_true',
+                        help='Collect the stats of every repository, even those not pushed to since the last run.')
+
+    parser.add_argument('--profile', required=False, default=None, action='store_true',
+                        help='Profile the run with cProfile, the result is saved in the output directory.')
+
+    parser.add_argument('-d', '--daemon', required=False, default=None, action='store_true',
+                        help='Keep running, refresh stats periodically and serve the latest ones over HTTP.')
+
+    parser.add_argument('--listen', required=False, default=None, action='store', type=str,
+                        help='Address and port the daemon listens on, as host:port.')
+
+    parser.add_argument('-b', '--batch', required=False, default=None, action='store_true',
+                        help='Collect stats for owner and every owner in extra_owners in a single run.')
+
+    parser.add_argument('--resume', required=False, default=None, action='store_true',
+                        help='Continue the last run if it was interrupted, collecting only what it had not yet.')
+
     parser.add_argument('-x', '--exclude', required=False, default=None, action='store', type=str, nargs=1,
                         help='Exclude the following comma-separated list of repositories.')
 
     args = parser.parse_args()
 
-    excluded_repos = None
+    # Authentication is added to each request by api.governor, which picks a token among the configured ones
+    header = {'Accept': 'application/vnd.github.v3+json'}
+
+    # {owner: is_organization} of a batch run, None for a run for owner alone
+    owners = None
+    if args.batch:
+        if not extra_owners:
+            raise Exception("There are no other owners to collect stats for, set extra_owners in config.py.")
+
+        owners = {owner: is_organization, **extra_owners}
+
+    # Pinging only needs the list of repositories and a request to each statistics endpoint, nothing else
     if args.ping:
-        use_cloc = True    # We don't need this but this way we avoid the prompt (since this is intended for automated operation)
-        get_commits = True
-        get_lines = False
+        if commits_from_git:
+            print("Commit stats are computed from the history of the repositories (commits_from_git), "
+                  "there is nothing to ping.")
+            return
+
+        repos = list(get_all_repos(header, owners))
+        print("\n\nPinging statistics endpoints...")
+        api.ping(repos, ['stats/commit_activity', 'stats/contributors'], header)
+        return
+
+    if args.replay or args.history:
+        if not warehouse_file or not os.path.isfile(warehouse_file):
+            raise Exception("There is no warehouse to read from, set warehouse_file in config.py and run once.")
+
+        name = '+'.join(owners) if owners else owner
+        store = Warehouse(warehouse_file)
+        run = store.latest_run(name)
+
+        if run is None:
+            raise Exception(f"There are no runs for {name} in the warehouse yet.")
+
+        if args.history:
+            from activity import ActivityMatrix, COMMITS, ADDITIONS, DELETIONS, year_edges
+
+            activity = ActivityMatrix(store.load_contributors(run[0]))
+            print(f"Activity by year in {name} repositories:")
+
+            if len(activity.weeks) > 0:
+                edges = year_edges(activity.weeks[0], activity.weeks[-1])
+                # Summed over authors: fields × periods
+                yearly = activity.periods(edges).sum(axis=1)
+
+                for i, edge in enumerate(edges[:-1]):
+                    print(f"\t{datetime.fromtimestamp(edge).year}: {yearly[COMMITS, i]} commits, "
+                          f"+{yearly[ADDITIONS, i]} -{yearly[DELETIONS, i]} lines")
+            print("\nSLOC over time:")
+            print("\n".join(f"\t{started_at}: {sloc}" for started_at, sloc in store.sloc_history(name)))
+            store.close()
+        else:
+            store.close()
+
+            if args.graphs or args.no_graphs:
+                generate_graphs = args.graphs
+            else:
+                generate_graphs = input("Do you want to generate graphs for the statistics? y/N ").lower() == 'y'
+
+            replay_last_run(generate_graphs, owners)
+            print(f"\n\n\nDone. You can see the results in the {output_dir} directory.")
+
+        return
+
+    if args.resume and not warehouse_file:
+        raise Exception("Runs are saved as they go in the warehouse, set warehouse_file in config.py to resume them.")
+
+    excluded_repos = None
+    if args.exclude and args.exclude[0]:
+        if "," in args.exclude[0]:
+            excluded_repos = [repo.lower() for repo in args.exclude[0].split(",")]
+        else:  # only 1 repo
+            excluded_repos = [args.exclude[0].lower()]
+
+    if args.daemon:
+        # Nothing can be asked in daemon mode: every statistic is collected, unless disabled from the command line
+        use_cloc = bool(args.cloc)
+        get_lines = not args.no_sloc
+        settings = (use_cloc, not args.no_commits, get_lines, not args.no_lang and not (use_cloc and get_lines),
+                    not args.no_graphs)
+
+        # Refreshes run while the HTTP server is serving requests: worker processes are forked from a fork server,
+        # a process of its own with a single thread, instead of from this one
+        worker_context = multiprocessing.get_context('forkserver')
+
+        def refresh():
+            metrics.reset()
+            graphql_api.forget_repositories()
+            history.forget()
+            # A refresh that failed (e.g. because of the rate limit) is resumed by the next one
+            return collect_all_stats(header, *settings, excluded_repos, args.full, owners, resume=True,
+                                     worker_context=worker_context)
+
+        def ping():
+            # Commit stats computed from the history of the repositories do not need GitHub to prepare anything
+            if not commits_from_git:
+                api.ping(list(get_all_repos(header, owners)), ['stats/commit_activity', 'stats/contributors'], header)
+
+        host, port = args.listen.rsplit(':', 1) if args.listen else (daemon_host, daemon_port)
+        StatsDaemon(refresh, ping, lambda: replay_last_run(settings[-1], owners), daemon_refresh_interval,
+                    daemon_ping_interval).serve(host, int(port))
+        return
+
+    if args.cloc or args.wc:
+        use_cloc = args.cloc
+    else:
+        use_cloc = input("Do you want to use cloc (C) or wc (W) to count SLOC? c/W ").lower() == "c"
+
+    if args.commits or args.no_commits:
+        get_commits = args.commits
+    else:
+        get_commits = input("Do you want to get the commits stats? It may take a long time due to GitHub servers "
+                            "updating their cache. y/N ").lower() == "y"
+
+    if args.sloc or args.no_sloc:
+        get_lines = args.sloc
+    else:
+        get_lines = input("Do you want to get the SLOC stats? It may take a long time since it "
+                          "has to clone each repository. y/N ").lower() == "y"
+
+    # If CLOC is being used, ignore API based language statistics
+    if (args.lang or args.no_lang) and not (use_cloc and get_lines):
+        get_languages = args.lang
+    elif not (use_cloc and get_lines):
+        get_languages = input("Do you want to generate language statistics? y/N ").lower() == 'y'
+    else:
         get_languages = False
-        generate_graphs = False
+
+    if args.graphs or args.no_graphs:
+        generate_graphs = args.graphs
     else:
-        if args.cloc or args.wc:
-            use_cloc = args.cloc
-        else:
-            use_cloc = input("Do you want to use cloc (C) or wc (W) to count SLOC? c/W ").lower() == "c"
+        generate_graphs = input("Do you want to generate graphs for the statistics? y/N ").lower() == 'y'
 
-        if args.commits or args.no_commits:
-            get_commits = args.commits
-        else:
-            get_commits = input("Do you want to get the commits stats? It may take a long time due to GitHub servers "
-                                "updating their cache. y/N ").lower() == "y"
+    # Only the main process is profiled, SLOC and graph workers are not
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
 
-        if args.sloc or args.no_sloc:
-            get_lines = args.sloc
-        else:
-            get_lines = input("Do you want to get the SLOC stats? It may take a long time since it "
-                              "has to clone each repository. y/N ").lower() == "y"
-
-        # If CLOC is being used, ignore API based language statistics
-        if (args.lang or args.no_lang) and not (use_cloc and get_lines):
-            get_languages = args.lang
-        elif not (use_cloc and get_lines):
-            get_languages = input("Do you want to generate language statistics? y/N ").lower() == 'y'
-        else:
-            get_languages = False
+    collect_all_stats(header, use_cloc, get_commits, get_lines, get_languages, generate_graphs, excluded_repos,
+                      args.full, owners, args.resume)
 
-        if args.graphs or args.no_graphs:
-            generate_graphs = args.graphs
-        else:
-            generate_graphs = input("Do you want to generate graphs for the statistics? y/N ").lower() == 'y'
-
-        if args.exclude and args.exclude[0]:
-            if "," in args.exclude[0]:
-                excluded_repos = [repo.lower() for repo in args.exclude[0].split(",")]
-            else:  # only 1 repo
-                excluded_repos = args.exclude[0].lower()
-
-    header = {'Authorization': f"token {token}"} if token != "YOUR TOKEN HERE" else {}
-
-    repos = get_repos(header)
-    if excluded_repos:
-        repos = [repo for repo in repos if repo.lower() not in excluded_repos]
-    commits_stats = get_anonymous_commits_stats(repos, header) if get_commits else None
-    contributors_stats = get_contributors_commits_stats(repos, header) if get_commits else None
-    lines_stats, cloc_language_repo, cloc_language_total = get_lines_stats(repos, use_cloc) if get_lines else (None, None, None)
-    language_total, language_repo = get_language_stats(repos, header) if (get_languages and not use_cloc) else (None, None)
-    
-    if not args.ping:    
-        print_all_stats(repos, commits_stats, lines_stats, contributors_stats, cloc_language_total or language_total, cloc_language_repo or language_repo, use_cloc, generate_graphs)
-        print(f"\n\n\nDone. You can see the results in the {output_dir} directory.")
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(output_dir, 'profile.pstats'))
+
+    print(f"\n\n\nDone. You can see the results in the {output_dir} directory.")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import time
+import resource
+from threading import Lock
+from contextlib import contextmanager
+
+# Lightweight instrumentation of a run: counters (requests by status, bytes cloned, subprocesses...) and timers
+# (phases, steps of each repository) kept in memory, then written as a JSON report and as a Prometheus text file.
+# Worker processes start from an empty set of metrics and hand theirs over to the main process with take().
+
+prefix = 'sardina_'
+
+_lock = Lock()
+_values = {}  # {(name, ((label, value), ...)): number}
+_types = {}  # {name: 'counter' or 'gauge'}
+_started = time.time()
+
+
+def _reset_lock():
+    # A process forked while another thread held the lock (see PhaseScheduler) would find it held forever
+    global _lock
+    _lock = Lock()
+
+
+os.register_at_fork(after_in_child=_reset_lock)
+
+
+def _add(kind: str, name: str, value: float, labels: dict):
+    key = (name, tuple(sorted(labels.items())))
+
+    with _lock:
+        _types[name] = kind
+        _values[key] = _values.get(key, 0) + value
+
+
+def count(name: str, value: float = 1, **labels):
+    _add('counter', name, value, labels)
+
+
+@contextmanager
+def timer(name: str, **labels):
+    # Add the seconds spent in the block to a gauge, a block running more than once (e.g. retries) adds up
+    started = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        _add('gauge', name, time.perf_counter() - started, labels)
+
+
+def reset():
+    # Start again from scratch, duration_seconds included: the daemon resets the metrics before each refresh, so
+    # that its reports cover that refresh and not its whole uptime
+    global _started
+
+    with _lock:
+        _values.clear()
+        _types.clear()
+        _started = time.time()
+
+
+def take() -> list:
+    # Return the metrics gathered so far as [(kind, name, labels, value)] and start again from scratch, used by
+    # worker processes to send their metrics along with their results
+    with _lock:
+        taken = [(_types[name], name, dict(labels), value) for (name, labels), value in _values.items()]
+        _values.clear()
+        _types.clear()
+
+    return taken
+
+
+def merge(taken: list):
+    for kind, name, labels, value in taken:
+        _add(kind, name, value, labels)
+
+
+def _peak_rss() -> dict:
+    # Peak resident set size in bytes of this process and of the largest of its terminated children (worker
+    # processes, git, cloc). ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {'main': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale}
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def write_reports(directory: str):
+    # Write metrics.json and metrics.prom (Prometheus text format, e.g. for node_exporter's textfile collector)
+    rss = _peak_rss()
+
+    with _lock:
+        values = sorted(_values.items())
+        types = dict(_types)
+
+    report = {'started_at': _started, 'duration_seconds': time.time() - _started, 'peak_rss_bytes': rss,
+              'metrics': {}}
+
+    for (name, labels), value in values:
+        report['metrics'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+
+    with open(os.path.join(directory, 'metrics.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+
+    lines = []
+    described = set()
+
+    for (name, labels), value in values:
+        if name not in described:
+            described.add(name)
+            lines.append(f'# TYPE {prefix}{name} {types[name]}')
+
+        label_text = ','.join(f'{label}="{_escape(label_value)}"' for label, label_value in labels)
+        lines.append(f'{prefix}{name}{{{label_text}}} {value}' if label_text else f'{prefix}{name} {value}')
+
+    lines.append(f'# TYPE {prefix}duration_seconds gauge')
+    lines.append(f'{prefix}duration_seconds {report["duration_seconds"]}')
+    lines.append(f'# TYPE {prefix}peak_rss_bytes gauge')
+    lines += [f'{prefix}peak_rss_bytes{{process="{process}"}} {value}' for process, value in rss.items()]
+
+    # Written to a temporary file first, so that a scraper never reads half a file
+    path = os.path.join(directory, 'metrics.prom')
+    with open(path + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import metrics
+
+
+class PhaseScheduler:
+    # Runs the phases of a run as soon as the phases they depend on are done, instead of one after the other: phases
+    # waiting for GitHub overlap with the ones cloning and counting, so that a run takes about as long as its longest
+    # chain of dependent phases instead of the sum of all of them.
+    # Each phase runs in its own thread, is timed as phase_seconds and is given the results of its dependencies as
+    # arguments, in the order they were listed.
+    def __init__(self):
+        self.phases = {}  # {name: (function, [dependencies])}
+
+    def add(self, name: str, function, dependencies: list = ()):
+        # Phases can only depend on phases added before them, so there can be no cycle
+        for dependency in dependencies:
+            if dependency not in self.phases:
+                raise Exception(f"Phase {name} depends on {dependency}, which was not added before it")
+
+        self.phases[name] = (function, list(dependencies))
+
+    def run(self) -> dict:
+        # Returns {name: result} of every phase. When a phase fails no other phase is started, the ones already
+        # running are waited for and the exception is raised again.
+        results = {}
+        pending = dict(self.phases)
+        running = {}
+        error = None
+
+        def run_phase(name: str, function, arguments: list):
+            with metrics.timer('phase_seconds', phase=name):
+                return function(*arguments)
+
+        with ThreadPoolExecutor(max_workers=max(1, len(self.phases))) as pool:
+            while pending or running:
+                if error is None:
+                    for name, (function, dependencies) in list(pending.items()):
+                        if all(dependency in results for dependency in dependencies):
+                            del pending[name]
+                            running[pool.submit(run_phase, name, function,
+                                                [results[dependency] for dependency in dependencies])] = name
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    name = running.pop(future)
+
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        error = error or e
+
+        if error is not None:
+            raise error
+
+        return results
@@ -0,0 +1,256 @@
+import os
+import re
+import mmap
+from threading import Thread
+from tempfile import NamedTemporaryFile
+from subprocess import run, Popen, PIPE, DEVNULL
+
+import metrics
+import languages
+
+# A line is non-blank if it contains at least one non-whitespace character
+_non_blank_line = re.compile(rb'^[ \t\r\f\v]*\S', re.MULTILINE)
+
+# Same heuristic git uses to tell binary files apart: a NUL byte among the first 8000 bytes
+_binary_probe_size = 8000
+
+
+def is_binary(data) -> bool:
+    return b'\0' in data[:_binary_probe_size]
+
+
+def count_non_blank_lines(data) -> int:
+    # Works on anything supporting the buffer protocol (bytes, mmap), returns 0 for binary content
+    if is_binary(data):
+        return 0
+
+    return sum(1 for _ in _non_blank_line.finditer(data))
+
+
+def count_file_lines(path: str) -> int:
+    # Files are memory-mapped instead of being read, so even huge ones are scanned without copying them around.
+    # Symlinks are skipped, the file they point to is either counted on its own or not part of the repository.
+    if os.path.islink(path):
+        return 0
+
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return 0
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return count_non_blank_lines(data)
+
+    # Broken symlinks, submodules and the like are listed by git but cannot be read as files
+    except (IsADirectoryError, FileNotFoundError, ValueError):
+        return 0
+
+
+def _read_file(path: str):
+    # Content of a file of a working tree, None for symlinks and for what cannot be read, see count_file_lines
+    if os.path.islink(path):
+        return None
+
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except (IsADirectoryError, FileNotFoundError):
+        return None
+
+
+def list_tree_files(path: str) -> list:
+    # List (file name, blob SHA) for every file in the HEAD tree, straight from the object database: this works on
+    # bare clones too, since no working tree is needed. Symlinks and submodules are left out like in a checkout.
+    # -z prints file names verbatim separated by NUL, instead of quoting and escaping the unusual ones.
+    metrics.count('subprocesses_total', command='git')
+    output = run(['git', 'ls-tree', '-r', '-z', 'HEAD'], cwd=path, capture_output=True).stdout
+    files = []
+
+    for entry in output.split(b'\0'):
+        if not entry:
+            continue
+
+        info, name = entry.split(b'\t', 1)
+        mode, kind, sha = info.split()
+
+        if kind == b'blob' and mode != b'120000':
+            files.append((os.fsdecode(name), sha.decode()))
+
+    return files
+
+
+def missing_blobs(path: str) -> set:
+    # SHAs of the blobs of HEAD left out of a partial clone (see clones.prepare_clone). Asking git for them, as
+    # `git cat-file` would, fetches them one at a time from GitHub: rev-list only lists them.
+    metrics.count('subprocesses_total', command='git')
+    output = run(['git', 'rev-list', '--objects', '--missing=print', 'HEAD'], cwd=path, capture_output=True).stdout
+    return {line[1:].decode() for line in output.splitlines() if line.startswith(b'?')}
+
+
+def fetch_blobs(path: str, shas: list) -> bool:
+    # Fetch blobs left out of a partial clone in a single request, the way git itself fetches the blobs a checkout
+    # needs, instead of one request per blob. Returns whether they were fetched.
+    if not shas:
+        return True
+
+    metrics.count('subprocesses_total', command='git')
+    return run(['git', '-c', 'fetch.negotiationAlgorithm=noop', 'fetch', 'origin', '--no-tags', '--no-write-fetch-head',
+                '--recurse-submodules=no', '--filter=blob:none', '--stdin'], cwd=path,
+               input=''.join(f'{sha}\n' for sha in shas).encode(), stdout=DEVNULL, stderr=DEVNULL).returncode == 0
+
+
+def _fetch_absent(path: str, shas: list, absent: set) -> set:
+    # Fetch the blobs among shas that were left out of the clone (see missing_blobs), returns the ones that are still
+    # absent: none of them, unless fetching failed
+    wanted = [sha for sha in dict.fromkeys(shas) if sha in absent]
+    fetched = fetch_blobs(path, wanted)
+    metrics.count('absent_blobs_total', len(wanted), state='fetched' if fetched else 'skipped')
+    return set() if fetched else set(wanted)
+
+
+def _read_blobs(path: str, shas: list):
+    # Stream the content of many blobs through a single `git cat-file --batch` process, yields (sha, content) in the
+    # same order as shas. content is None for missing blobs.
+    if not shas:
+        return
+
+    metrics.count('subprocesses_total', command='git')
+    process = Popen(['git', 'cat-file', '--batch'], cwd=path, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+
+    # Requests are written from another thread, otherwise both pipes could fill up and block each other
+    def request():
+        for sha in shas:
+            process.stdin.write(f'{sha}\n'.encode())
+        process.stdin.close()
+
+    writer = Thread(target=request)
+    writer.start()
+
+    for sha in shas:
+        header = process.stdout.readline().split()
+
+        # <sha> missing
+        if len(header) < 3:
+            yield sha, None
+            continue
+
+        # <sha> <type> <size>, then the content and a newline
+        data = process.stdout.read(int(header[2]))
+        process.stdout.read(1)
+        yield sha, data
+
+    writer.join()
+    process.wait()
+
+
+def count_blob_lines(path: str, shas: list) -> dict:
+    # Count the lines of many blobs read from the object database.
+    # Returns {sha: non-blank lines}, identical blobs are only read and counted once.
+    return {sha: count_non_blank_lines(data) if data is not None else 0
+            for sha, data in _read_blobs(path, list(dict.fromkeys(shas)))}
+
+
+def count_tree_lines(path: str, files: list, from_objects: bool = True, cache=None, absent: set = None) -> int:
+    # Count the lines of a list of (file name, blob SHA), as returned by list_tree_files. Blobs found in the cache
+    # are not counted again, the others are read from the object database or from the working tree.
+    # Absent blobs, the ones too big to be cloned (see missing_blobs), are fetched all at once before being read. If
+    # that fails they count as 0 like binary files, and are not cached so that a later run counts them.
+    counts = cache.get_lines([sha for _, sha in files]) if cache else {}
+    absent = _fetch_absent(path, [sha for _, sha in files if sha not in counts], absent) if absent else set()
+    counts.update({sha: 0 for _, sha in files if sha in absent})
+    missing = [(name, sha) for name, sha in files if sha not in counts]
+
+    if from_objects:
+        new = count_blob_lines(path, [sha for _, sha in missing])
+    else:
+        new = {sha: count_file_lines(os.path.join(path, name)) for name, sha in missing}
+
+    if cache and new:
+        cache.put_lines(new)
+
+    counts.update(new)
+    return sum(counts[sha] for _, sha in files)
+
+
+def _run_cloc(path: str, names: list) -> dict:
+    # Run cloc on a list of files of a working tree, returns {name: (language, blank, comment, code)}
+    # for the files cloc recognizes
+    with NamedTemporaryFile('w', suffix='.txt') as list_file:
+        list_file.write(''.join(f'{name}\n' for name in names))
+        list_file.flush()
+
+        metrics.count('subprocesses_total', command='cloc')
+        output = run(['cloc', '--by-file', '--csv', '--quiet', '--hide-rate', f'--list-file={list_file.name}'],
+                     cwd=path, text=True, capture_output=True).stdout.splitlines()
+
+    results = {}
+    header = False
+
+    # Skip everything up to the header, file names can contain commas so the numbers are split from the right
+    for line in output:
+        if not header:
+            header = line.startswith('language,')
+            continue
+
+        language, rest = line.split(',', 1)
+        name, blank, comment, code = rest.rsplit(',', 3)
+
+        if language != 'SUM':
+            results[name] = (language, int(blank), int(comment), int(code))
+
+    return results
+
+
+def cloc_tree_files(path: str, files: list, cache=None) -> list:
+    # Count code, comment and blank lines with cloc for a list of (file name, blob SHA) of a working tree.
+    # Returns a list of (language, blank, comment, code), language is None for files cloc does not recognize.
+    # Like cloc itself, identical files are only counted once. Blobs found in the cache are not counted again.
+    unique = {sha: name for name, sha in files}
+    keys = {(sha, os.path.basename(name)): name for sha, name in unique.items()}
+    results = cache.get_cloc(list(keys)) if cache else {}
+    missing = {key: name for key, name in keys.items() if key not in results}
+
+    if missing:
+        counted = _run_cloc(path, list(missing.values()))
+        new = {key: counted.get(name, (None, 0, 0, 0)) for key, name in missing.items()}
+
+        if cache:
+            cache.put_cloc(new)
+
+        results.update(new)
+
+    return [results[key] for key in keys]
+
+
+def _count_code(name: str, data) -> tuple:
+    # (language, blank, comment, code) of a file with the built-in counter, binary files are not recognized
+    if data is None or is_binary(data):
+        return None, 0, 0, 0
+
+    return languages.count_file(name, data)
+
+
+def count_tree_languages(path: str, files: list, from_objects: bool = True, cache=None, absent: set = None) -> list:
+    # Like cloc_tree_files, but with the built-in counter of languages.py instead of cloc: files are read from the
+    # object database (or from the working tree) and counted in this process, without starting cloc for each
+    # repository. Absent blobs are fetched first (see count_tree_lines), the ones that could not be are not recognized
+    # and not cached.
+    unique = {sha: name for name, sha in files}
+    keys = {(sha, os.path.basename(name)): name for sha, name in unique.items()}
+    results = cache.get_cloc(list(keys), native=True) if cache else {}
+    absent = _fetch_absent(path, [key[0] for key in keys if key not in results], absent) if absent else set()
+    results.update({key: (None, 0, 0, 0) for key in keys if key[0] in absent})
+    missing = {key: name for key, name in keys.items() if key not in results}
+
+    if from_objects:
+        names = {sha: name for (sha, _), name in missing.items()}
+        new = {(sha, os.path.basename(names[sha])): _count_code(names[sha], data)
+               for sha, data in _read_blobs(path, list(names))}
+    else:
+        new = {key: _count_code(name, _read_file(os.path.join(path, name))) for key, name in missing.items()}
+
+    if cache and new:
+        cache.put_cloc(new, native=True)
+
+    results.update(new)
+    return [results[key] for key in keys]
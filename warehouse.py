@@ -0,0 +1,440 @@
+import sqlite3
+from threading import Lock
+from datetime import datetime
+
+_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner TEXT NOT NULL,
+    started_at TEXT NOT NULL,
+    use_cloc INTEGER NOT NULL,
+    -- NULL until the run is done, runs that never finished were interrupted and can be resumed
+    finished_at TEXT
+);
+
+-- One row per repository per run, NULL where the statistic was not collected
+CREATE TABLE IF NOT EXISTS repositories (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    repo TEXT NOT NULL,
+    commits_past_year INTEGER,
+    sloc INTEGER,
+    comments INTEGER,
+    blanks INTEGER,
+    pushed_at TEXT,
+    PRIMARY KEY (run_id, repo)
+);
+
+-- Which statistics were gathered for a repository in a run: commit_activity, contributors, cloc, native, wc or
+-- languages
+CREATE TABLE IF NOT EXISTS collected (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    repo TEXT NOT NULL,
+    statistic TEXT NOT NULL,
+    -- The run whose rows hold the statistic when it was reused from there instead of being collected, NULL otherwise
+    source_run_id INTEGER REFERENCES runs (id),
+    PRIMARY KEY (run_id, repo, statistic)
+);
+
+CREATE TABLE IF NOT EXISTS contributors (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    repo TEXT NOT NULL,
+    login TEXT NOT NULL,
+    commits_total INTEGER NOT NULL,
+    commits_past_year INTEGER NOT NULL,
+    PRIMARY KEY (run_id, repo, login)
+);
+
+-- Weekly activity as returned by /stats/contributors, week is the UNIX timestamp of the start of the week
+CREATE TABLE IF NOT EXISTS contributor_weeks (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    repo TEXT NOT NULL,
+    login TEXT NOT NULL,
+    week INTEGER NOT NULL,
+    commits INTEGER NOT NULL,
+    additions INTEGER NOT NULL,
+    deletions INTEGER NOT NULL,
+    PRIMARY KEY (run_id, repo, login, week)
+);
+
+-- Weekly commits as returned by /stats/commit_activity, anonymous commits included
+CREATE TABLE IF NOT EXISTS repository_weeks (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    repo TEXT NOT NULL,
+    week INTEGER NOT NULL,
+    commits INTEGER NOT NULL,
+    PRIMARY KEY (run_id, repo, week)
+);
+
+-- Bytes (GitHub) or lines of code (cloc) per language
+CREATE TABLE IF NOT EXISTS languages (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    repo TEXT NOT NULL,
+    language TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    PRIMARY KEY (run_id, repo, language)
+);
+
+CREATE INDEX IF NOT EXISTS runs_owner ON runs (owner, started_at);
+CREATE INDEX IF NOT EXISTS contributors_login ON contributors (login);
+CREATE INDEX IF NOT EXISTS contributor_weeks_week ON contributor_weeks (run_id, week);
+CREATE INDEX IF NOT EXISTS contributor_weeks_login ON contributor_weeks (login, week);
+CREATE INDEX IF NOT EXISTS repository_weeks_week ON repository_weeks (run_id, week);
+CREATE INDEX IF NOT EXISTS languages_language ON languages (language);
+"""
+
+
+# Tables with rows for each repository of a run
+_repository_tables = ['repositories', 'collected', 'contributors', 'contributor_weeks', 'repository_weeks', 'languages']
+
+# Tables holding each statistic, which runs reusing it point to instead of copying it (see mark_reused). Line counts
+# are in the repositories rows of the run they were counted by.
+_statistic_tables = {'commit_activity': ['repository_weeks'], 'contributors': ['contributors', 'contributor_weeks'],
+                     'languages': ['languages'], 'cloc': ['repositories', 'languages'],
+                     'native': ['repositories', 'languages'], 'wc': ['repositories']}
+
+
+class Warehouse:
+    # Local SQLite store of the facts gathered by every run (per repository, contributor, week and language), kept
+    # as snapshots: reports, graphs and comparisons with previous runs can be made again without GitHub or clones.
+    # Collectors running at the same time (see PhaseScheduler) share the connection, one statement at a time.
+    def __init__(self, path: str):
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(_schema)
+
+        # Statistics are committed repository by repository while they are collected, the write-ahead log makes
+        # that cheap. Losing the last ones on a power failure only means collecting them again.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+
+        # Warehouses made before pushed_at was stored
+        if 'pushed_at' not in [column[1] for column in self.db.execute("PRAGMA table_info(repositories)")]:
+            self.db.execute("ALTER TABLE repositories ADD COLUMN pushed_at TEXT")
+
+        # Warehouses made before runs could be resumed: their runs were stored all at once, when they finished
+        if 'finished_at' not in [column[1] for column in self.db.execute("PRAGMA table_info(runs)")]:
+            self.db.execute("ALTER TABLE runs ADD COLUMN finished_at TEXT")
+            self.db.execute("UPDATE runs SET finished_at = started_at WHERE id IN (SELECT run_id FROM repositories)")
+            self.db.commit()
+
+        # Warehouses made before reused statistics were pointed to: they were copied into each run
+        if 'source_run_id' not in [column[1] for column in self.db.execute("PRAGMA table_info(collected)")]:
+            self.db.execute("ALTER TABLE collected ADD COLUMN source_run_id INTEGER REFERENCES runs (id)")
+
+        self.run_id = None
+        self.owner = None
+        self.pushed_at = {}
+        self.reuse = False
+        self.resumed = False
+
+    def start_run(self, owner: str, use_cloc: bool, pushed_at: dict = None, reuse: bool = False) -> int:
+        # pushed_at is {repo: time of the last push} as listed by GitHub. With reuse, statistics of repositories
+        # that were not pushed to since a previous run can be taken from that run instead of being collected again.
+        self.owner = owner
+        self.pushed_at = pushed_at or {}
+        self.reuse = reuse
+        self.run_id = self.db.execute("INSERT INTO runs (owner, started_at, use_cloc) VALUES (?, ?, ?)",
+                                      (owner, datetime.now().isoformat(), bool(use_cloc))).lastrowid
+        self.db.commit()
+        return self.run_id
+
+    def resume_run(self, owner: str, use_cloc: bool, pushed_at: dict = None, reuse: bool = False) -> int:
+        # Continue the last run of owner instead of starting a new one, if it was interrupted before finish_run. The
+        # statistics it stored for repositories that were not pushed to since then are reused (see reusable), the
+        # others are forgotten and collected again. Same arguments as start_run. Returns the id of the run, or None
+        # if the last run of owner finished or there is none.
+        run = self.db.execute("SELECT id, finished_at FROM runs WHERE owner = ? ORDER BY id DESC LIMIT 1",
+                              (owner,)).fetchone()
+
+        if run is None or run[1] is not None:
+            return None
+
+        self.owner = owner
+        self.pushed_at = pushed_at or {}
+        self.reuse = reuse
+        self.resumed = True
+        self.run_id = run[0]
+
+        stored = self.db.execute("SELECT repo, pushed_at FROM repositories WHERE run_id = ?", (self.run_id,))
+        self._forget([repo for repo, stored_at in stored.fetchall()
+                      if repo not in self.pushed_at or stored_at != self.pushed_at[repo]])
+        self.db.execute("UPDATE runs SET use_cloc = ? WHERE id = ?", (bool(use_cloc), self.run_id))
+        self.db.commit()
+        return self.run_id
+
+    def _forget(self, repos: list):
+        # Delete everything the current run stored for repos
+        for table in _repository_tables:
+            self.db.executemany(f"DELETE FROM {table} WHERE run_id = ? AND repo = ?",
+                                [(self.run_id, repo) for repo in repos])
+
+    def _add_repository(self, repo: str):
+        self.db.execute("INSERT OR IGNORE INTO repositories (run_id, repo, pushed_at) VALUES (?, ?, ?)",
+                        (self.run_id, repo, self.pushed_at.get(repo)))
+
+    def mark_collected(self, repo: str, statistic: str):
+        # Called once the statistic of repo is stored, which is committed right away: if the run is interrupted, it
+        # can be resumed from there (see resume_run)
+        with self.lock:
+            self._add_repository(repo)
+            self.db.execute("INSERT OR REPLACE INTO collected (run_id, repo, statistic) VALUES (?, ?, ?)",
+                            (self.run_id, repo, statistic))
+            self.db.commit()
+
+    def mark_reused(self, repo: str, statistic: str, run_id: int):
+        # Same as mark_collected, for a statistic taken from run_id (as returned by reusable): the run points to the
+        # rows of run_id instead of storing a copy of them
+        with self.lock:
+            self._add_repository(repo)
+            self.db.execute("INSERT OR REPLACE INTO collected VALUES (?, ?, ?, ?)",
+                            (self.run_id, repo, statistic, run_id if run_id != self.run_id else None))
+            self.db.commit()
+
+    def reusable(self, repos: list, statistic: str) -> dict:
+        # Returns {repo: run id} for the repositories among repos whose statistic was collected by a previous run
+        # (with reuse) or by the run itself before it was interrupted (once resumed), and that were not pushed to
+        # since then, taking the most recent of such runs. The run id is the one holding the rows of the statistic,
+        # which is not the run itself if that reused it in turn.
+        if not self.reuse and not self.resumed:
+            return {}
+
+        # SQLite takes the other columns from the row with the MAX, so the source is the one of the most recent run
+        with self.lock:
+            rows = self.db.execute("SELECT collected.repo, repositories.pushed_at, MAX(collected.run_id), "
+                                   "COALESCE(collected.source_run_id, collected.run_id) "
+                                   "FROM collected JOIN runs ON runs.id = collected.run_id "
+                                   "JOIN repositories ON repositories.run_id = collected.run_id "
+                                   "AND repositories.repo = collected.repo "
+                                   "WHERE runs.owner = ? AND collected.statistic = ? AND (? OR collected.run_id = ?) "
+                                   "GROUP BY collected.repo, repositories.pushed_at",
+                                   (self.owner, statistic, self.reuse, self.run_id)).fetchall()
+        runs = {(repo, pushed_at): source for repo, pushed_at, _, source in rows if pushed_at is not None}
+
+        return {repo: runs[(repo, self.pushed_at.get(repo))] for repo in repos
+                    if (repo, self.pushed_at.get(repo)) in runs}
+
+    def load_repository_weeks(self, run_id: int, repo: str) -> list:
+        # Same shape as the /stats/commit_activity response, only the fields sardina uses
+        with self.lock:
+            return [{'week': week, 'total': commits} for week, commits in
+                    self.db.execute("SELECT week, commits FROM repository_weeks WHERE run_id = ? AND repo = ? "
+                                    "ORDER BY week", (run_id, repo))]
+
+    def load_contributor_weeks(self, run_id: int, repo: str) -> list:
+        # Same shape as the /stats/contributors response, only the fields sardina uses
+        with self.lock:
+            contributors = {login: {'author': {'login': login}, 'total': total, 'weeks': []} for login, total in
+                            self.db.execute("SELECT login, commits_total FROM contributors "
+                                            "WHERE run_id = ? AND repo = ? ORDER BY rowid", (run_id, repo))}
+
+            for login, week, commits, additions, deletions in \
+                    self.db.execute("SELECT login, week, commits, additions, deletions FROM contributor_weeks "
+                                    "WHERE run_id = ? AND repo = ? ORDER BY week", (run_id, repo)):
+                if login in contributors:
+                    contributors[login]['weeks'].append({'w': week, 'c': commits, 'a': additions, 'd': deletions})
+
+            return list(contributors.values())
+
+    def load_lines(self, run_id: int, repo: str):
+        # (sloc, comments, blanks), comments and blanks are None for lines counted with wc
+        with self.lock:
+            return self.db.execute("SELECT sloc, comments, blanks FROM repositories WHERE run_id = ? AND repo = ?",
+                                   (run_id, repo)).fetchone()
+
+    def load_languages(self, run_id: int, repo: str) -> dict:
+        with self.lock:
+            return dict(self.db.execute("SELECT language, amount FROM languages WHERE run_id = ? AND repo = ? "
+                                        "ORDER BY rowid", (run_id, repo)))
+
+    # The add_* methods replace what the run stored for a repository before, if anything
+
+    def add_repository_weeks(self, repo: str, commit_activity: list):
+        with self.lock:
+            self.db.execute("DELETE FROM repository_weeks WHERE run_id = ? AND repo = ?", (self.run_id, repo))
+            self.db.executemany("INSERT OR REPLACE INTO repository_weeks VALUES (?, ?, ?, ?)",
+                                [(self.run_id, repo, week['week'], week['total']) for week in commit_activity])
+
+    def add_contributor_weeks(self, repo: str, contributors: list):
+        # Commits of the past year are only known once every repository is collected, finish_run stores them
+        with self.lock:
+            self.db.execute("DELETE FROM contributors WHERE run_id = ? AND repo = ?", (self.run_id, repo))
+            self.db.execute("DELETE FROM contributor_weeks WHERE run_id = ? AND repo = ?", (self.run_id, repo))
+            self.db.executemany("INSERT OR REPLACE INTO contributors VALUES (?, ?, ?, ?, 0)",
+                                [(self.run_id, repo, author['author']['login'], author['total'])
+                                 for author in contributors])
+            self.db.executemany("INSERT OR REPLACE INTO contributor_weeks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(self.run_id, repo, author['author']['login'], week['w'], week['c'], week['a'],
+                                  week['d']) for author in contributors for week in author['weeks']])
+
+    def add_lines(self, repo: str, sloc: int, comments: int = None, blanks: int = None):
+        with self.lock:
+            self._add_repository(repo)
+            self.db.execute("UPDATE repositories SET sloc = ?, comments = ?, blanks = ? WHERE run_id = ? AND repo = ?",
+                            (sloc, comments, blanks, self.run_id, repo))
+
+    def add_languages(self, repo: str, languages: dict):
+        with self.lock:
+            self.db.execute("DELETE FROM languages WHERE run_id = ? AND repo = ?", (self.run_id, repo))
+            self.db.executemany("INSERT OR REPLACE INTO languages VALUES (?, ?, ?, ?)",
+                                [(self.run_id, repo, language, amount)
+                                 for language, amount in languages.items() if language != 'total'])
+
+    def finish_run(self, repos: list, commits_stats: dict, lines_stats: dict, contributors_stats: dict,
+                   language_repo: dict, use_cloc: bool):
+        # Store the per-repository results of the run, totals are not stored since they can be computed back.
+        # Repositories a resumed run stored before and does not cover anymore (e.g. excluded since) are dropped.
+        stored = [repo for repo, in self.db.execute("SELECT repo FROM repositories WHERE run_id = ?", (self.run_id,))]
+        self._forget(list(set(stored) - set(repos)))
+
+        # Languages reused from a previous run stay there
+        reused = {repo for repo, in self.db.execute("SELECT repo FROM collected WHERE run_id = ? "
+                                                    "AND source_run_id IS NOT NULL AND statistic IN "
+                                                    "('languages', 'cloc', 'native')", (self.run_id,))}
+
+        for repo in repos:
+            lines = lines_stats.get(repo) if lines_stats is not None else None
+
+            if lines is None:
+                sloc, comments, blanks = None, None, None
+            elif use_cloc:
+                sloc, comments, blanks = lines['sloc'], lines['comments'], lines['blanks']
+            else:
+                sloc, comments, blanks = lines, None, None
+
+            commits = commits_stats.get(repo) if commits_stats is not None else None
+
+            self.db.execute("INSERT OR REPLACE INTO repositories VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (self.run_id, repo, commits, sloc, comments, blanks, self.pushed_at.get(repo)))
+
+            if contributors_stats is not None and repo in contributors_stats:
+                self.db.executemany("INSERT OR REPLACE INTO contributors VALUES (?, ?, ?, ?, ?)",
+                                    [(self.run_id, repo, login, total, contributors_stats[repo]['past_year'][login])
+                                     for login, total in contributors_stats[repo]['total'].items()])
+
+            if language_repo is not None and repo in language_repo and repo not in reused:
+                self.db.executemany("INSERT OR REPLACE INTO languages VALUES (?, ?, ?, ?)",
+                                    [(self.run_id, repo, language, amount)
+                                     for language, amount in language_repo[repo].items() if language != 'total'])
+
+        self.db.execute("UPDATE runs SET finished_at = ? WHERE id = ?", (datetime.now().isoformat(), self.run_id))
+        self.db.commit()
+
+    def delete_old_runs(self, keep: int) -> int:
+        # Delete the runs of the owner of the current run but the last keep finished ones (and the interrupted ones
+        # after them). Statistics that the remaining runs reused from a deleted one are kept, until no run points to
+        # them anymore. Returns how many runs were deleted.
+        with self.lock:
+            oldest = self.db.execute("SELECT id FROM runs WHERE owner = ? AND finished_at IS NOT NULL "
+                                     "ORDER BY id DESC LIMIT 1 OFFSET ?", (self.owner, keep - 1)).fetchone()
+
+            if oldest is None:
+                return 0
+
+            # Runs only kept for the statistics other runs point to were already counted when they were deleted
+            deleted = [run_id for run_id, in self.db.execute("SELECT id FROM runs WHERE owner = ? AND id < ? "
+                                                             "AND id IN (SELECT run_id FROM collected)",
+                                                             (self.owner, oldest[0]))]
+            old = "SELECT id FROM runs WHERE owner = ? AND id < ?"
+
+            self.db.execute(f"DELETE FROM collected WHERE run_id IN ({old})", (self.owner, oldest[0]))
+
+            for table in set(sum(_statistic_tables.values(), [])):
+                statistics = [statistic for statistic, tables in _statistic_tables.items() if table in tables]
+                self.db.execute(f"DELETE FROM {table} WHERE run_id IN ({old}) AND NOT EXISTS "
+                                f"(SELECT * FROM collected WHERE collected.source_run_id = {table}.run_id "
+                                f"AND collected.repo = {table}.repo "
+                                f"AND collected.statistic IN ({', '.join('?' * len(statistics))}))",
+                                (self.owner, oldest[0], *statistics))
+
+            self.db.execute(f"DELETE FROM runs WHERE id IN ({old}) AND id NOT IN "
+                            f"(SELECT source_run_id FROM collected WHERE source_run_id IS NOT NULL)",
+                            (self.owner, oldest[0]))
+            self.db.commit()
+
+        return len(deleted)
+
+    def latest_run(self, owner: str):
+        # Returns (id, started_at, use_cloc) of the most recent run for owner, or None
+        return self.db.execute("SELECT id, started_at, use_cloc FROM runs WHERE owner = ? AND finished_at IS NOT NULL "
+                               "AND id IN (SELECT run_id FROM repositories) ORDER BY id DESC LIMIT 1",
+                               (owner,)).fetchone()
+
+    def load_run(self, run_id: int):
+        # Rebuild the structures print_all_stats expects from a stored run: (repos, commits_stats, lines_stats,
+        # contributors_stats, language_total, language_repo, use_cloc). Statistics that were not collected are None.
+        use_cloc = bool(self.db.execute("SELECT use_cloc FROM runs WHERE id = ?", (run_id,)).fetchone()[0])
+        rows = self.db.execute("SELECT repo, commits_past_year, sloc, comments, blanks FROM repositories "
+                               "WHERE run_id = ? ORDER BY rowid", (run_id,)).fetchall()
+        repos = [row[0] for row in rows]
+
+        commits_stats = None
+        if any(row[1] is not None for row in rows):
+            commits_stats = {'total': 0}
+            for repo, commits, *_ in rows:
+                if commits is not None:
+                    commits_stats[repo] = commits
+                    commits_stats['total'] += commits
+
+        lines_stats = None
+        if any(row[2] is not None for row in rows):
+            lines_stats = {'total': {'sloc': 0, 'all': 0}} if use_cloc else {'total': 0}
+            for repo, _, sloc, comments, blanks in rows:
+                if use_cloc:
+                    lines_stats[repo] = {'sloc': sloc, 'comments': comments, 'blanks': blanks}
+                    lines_stats['total']['sloc'] += sloc
+                    lines_stats['total']['all'] += sloc + comments + blanks
+                else:
+                    lines_stats[repo] = sloc
+                    lines_stats['total'] += sloc
+
+        contributors_stats = None
+        contributors = self.db.execute("SELECT repo, login, commits_total, commits_past_year FROM contributors "
+                                       "WHERE run_id = ? ORDER BY rowid", (run_id,)).fetchall()
+        if contributors or commits_stats is not None:
+            contributors_stats = {'total': {}, 'past_year': {}}
+            for repo in repos:
+                contributors_stats[repo] = {'total': {}, 'past_year': {}}
+
+            for repo, login, total, past_year in contributors:
+                contributors_stats[repo]['total'][login] = total
+                contributors_stats[repo]['past_year'][login] = past_year
+                contributors_stats['total'][login] = contributors_stats['total'].get(login, 0) + total
+                contributors_stats['past_year'][login] = contributors_stats['past_year'].get(login, 0) + past_year
+
+        # Languages reused from a previous run are in the rows of that run
+        language_total, language_repo = None, None
+        languages = self.db.execute("SELECT repositories.repo, languages.language, languages.amount "
+                                    "FROM repositories JOIN languages ON languages.repo = repositories.repo "
+                                    "AND languages.run_id = COALESCE((SELECT source_run_id FROM collected "
+                                    "WHERE collected.run_id = repositories.run_id "
+                                    "AND collected.repo = repositories.repo "
+                                    "AND statistic IN ('languages', 'cloc', 'native') LIMIT 1), repositories.run_id) "
+                                    "WHERE repositories.run_id = ? ORDER BY repositories.rowid, languages.rowid",
+                                    (run_id,)).fetchall()
+        if languages:
+            language_total = {'total': 0}
+            language_repo = {repo: {'total': 0} for repo in repos}
+            for repo, language, amount in languages:
+                language_repo[repo][language] = amount
+                language_repo[repo]['total'] += amount
+                language_total[language] = language_total.get(language, 0) + amount
+                language_total['total'] += amount
+
+        return repos, commits_stats, lines_stats, contributors_stats, language_total, language_repo, use_cloc
+
+    def load_contributors(self, run_id: int) -> dict:
+        # {repo: /stats/contributors response} for every repository whose contributors were collected by a run
+        repos = self.db.execute("SELECT repo, COALESCE(source_run_id, run_id) FROM collected WHERE run_id = ? "
+                                "AND statistic = 'contributors' ORDER BY rowid", (run_id,)).fetchall()
+        return {repo: self.load_contributor_weeks(source, repo) for repo, source in repos}
+
+    def sloc_history(self, owner: str) -> list:
+        # [(started_at, total SLOC)] for every run of owner that counted lines, oldest first
+        return self.db.execute("SELECT runs.started_at, SUM(repositories.sloc) FROM runs "
+                               "JOIN repositories ON repositories.run_id = runs.id "
+                               "WHERE runs.owner = ? AND runs.finished_at IS NOT NULL "
+                               "AND repositories.sloc IS NOT NULL GROUP BY runs.id ORDER BY runs.id", (owner,)).fetchall()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()